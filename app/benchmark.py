@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import contextlib
+import http.server
+import importlib
+import json
+import multiprocessing
+import os
+import pathlib
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import s2olib.server
+import s2olib.shared
+import s2olib.variants
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+DEFAULT_FIXTURES_DIR: pathlib.Path = pathlib.Path(__file__).parents[1].resolve() / 'doc' / 'example-cache'
+DEFAULT_CYCLES: int = 20
+DEFAULT_LATENCY: int = 0
+DEFAULT_ERROR_RATE: float = 0.0
+DEFAULT_CHANGE_RATE: float = 0.5
+
+STANDIN_RATE_LIMIT: int = 1_000_000
+
+ARGPARSER_SETUP: dict[str, any] = {
+    'description': 'Benchmark the tools offline against a local stand-in server. For more help see README.md or https://github.com/etrusci-org/space2obs',
+    'allow_abbrev': False,
+    'add_help': False,
+}
+
+ARGS: list[dict[str, any]] = [
+    {
+        'name_or_flags': ['--cycles'],
+        'metavar': 'NUM',
+        'type': int,
+        'default': DEFAULT_CYCLES,
+        'help': f'Set how many times each tool is run. Default: {DEFAULT_CYCLES}',
+    },
+    {
+        'name_or_flags': ['--latency'],
+        'metavar': 'MS',
+        'type': int,
+        'default': DEFAULT_LATENCY,
+        'help': f'Delay every response of the stand-in server by this many milliseconds. Default: {DEFAULT_LATENCY}',
+    },
+    {
+        'name_or_flags': ['--error-rate'],
+        'metavar': 'FLOAT',
+        'type': float,
+        'default': DEFAULT_ERROR_RATE,
+        'help': f'Set the share of requests answered with 503 Service Unavailable, from 0 to 1. Default: {DEFAULT_ERROR_RATE}',
+    },
+    {
+        'name_or_flags': ['--change-rate'],
+        'metavar': 'FLOAT',
+        'type': float,
+        'default': DEFAULT_CHANGE_RATE,
+        'help': f'Set the chance that a resource has changed since it was last requested, from 0 to 1. Unchanged resources are answered with 304 Not Modified. Default: {DEFAULT_CHANGE_RATE}',
+    },
+    {
+        'name_or_flags': ['--fixtures-dir'],
+        'metavar': 'PATH',
+        'type': pathlib.Path,
+        'default': DEFAULT_FIXTURES_DIR,
+        'help': f'Specify the directory with the recorded output files the stand-in server replays. Default: {DEFAULT_FIXTURES_DIR}',
+    },
+    {
+        'name_or_flags': ['--seed'],
+        'metavar': 'NUM',
+        'type': int,
+        'default': 0,
+        'help': 'Seed for the simulated errors and changes, so runs can be compared. Default: 0',
+    },
+    {
+        'name_or_flags': ['--output'],
+        'metavar': 'PATH',
+        'type': pathlib.Path,
+        'default': None,
+        'help': 'Additionally write the results as JSON to this file. Default: none',
+    },
+]
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+_fixtures: dict[str, bytes] = {}
+_versions: dict[str, int] = {}
+_stats: dict[str, int] = {'requests': 0, 'not_modified': 0, 'errors': 0, 'bytes': 0}
+_standin_lock: threading.Lock = threading.Lock()
+_standin_options: dict[str, any] = {}
+_random: random.Random = random.Random()
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def start_standin(args: argparse.Namespace) -> str:
+    for file in sorted(args.fixtures_dir.glob(s2olib.server.ASSET_PATTERN)):
+        _fixtures[file.name] = file.read_bytes()
+
+    if not _fixtures:
+        s2olib.shared.msg(f'no fixtures found in {args.fixtures_dir}')
+        exit(1)
+
+    _standin_options.update(latency=args.latency / 1000, error_rate=args.error_rate, change_rate=args.change_rate)
+    _random.seed(args.seed)
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def get_version(key: str, bump: bool = True) -> int:
+    with _standin_lock:
+        if key not in _versions:
+            _versions[key] = 0
+        elif bump and _random.random() < _standin_options['change_rate']:
+            _versions[key] += 1
+
+        return _versions[key]
+
+
+def get_body(name: str, version: int) -> bytes:
+    # trailing whitespace keeps json valid and is ignored after the end marker of an image
+    return _fixtures[name] + b' ' * (version % 64)
+
+
+def get_apod_data(base_url: str, count: int) -> list[dict[str, any]]:
+    text: list[str] = _fixtures.get('apod_last_text', b'?').decode().split('\n\n')
+
+    with _standin_lock:
+        first: int = _versions.setdefault('apod_image', 0)
+        _versions['apod_image'] += count
+
+    # every entry gets its own image url, just like new pictures would
+    return [{
+        'date': time.strftime('%Y-%m-%d'),
+        'title': text[0],
+        'explanation': text[1] if len(text) > 1 else '',
+        'copyright': 'space2obs benchmark',
+        'media_type': 'image',
+        'url': f'{base_url}/apod_image/{first + i}',
+    } for i in range(count)]
+
+
+def get_snapshot() -> dict[str, int]:
+    with _standin_lock:
+        return _stats.copy()
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self) -> None:
+        url = urllib.parse.urlsplit(self.path)
+        query: dict[str, list[str]] = urllib.parse.parse_qs(url.query)
+        parts: list[str] = url.path.strip('/').split('/')
+
+        time.sleep(_standin_options['latency'])
+
+        with _standin_lock:
+            _stats['requests'] += 1
+            failed: bool = _random.random() < _standin_options['error_rate']
+
+        if failed:
+            self.send_body(503, b'', 'text/plain')
+        elif parts[0] == 'apod' and len(parts) == 1:
+            data: bytes = json.dumps(get_apod_data(f'http://{self.headers["host"]}', int(query.get('count', ['1'])[0]))).encode()
+            self.send_body(200, data, 'application/json', xrate=True)
+        elif parts[0] == 'apod_image' and len(parts) == 2:
+            self.send_fixture(url.path, 'apod_last_image')
+        elif parts[0] == 'dnmap':
+            self.send_fixture(parts[0], 'dnmap_last_image')
+        elif parts[0] == 'eonet':
+            self.send_fixture(parts[0], 'eonet_last_data', xrate=True)
+        elif parts[0] == 'soho' and len(parts) == 2:
+            self.send_fixture(url.path, f'soho_last_{parts[1]}_image')
+        elif parts[0] == 'mirror' and len(parts) == 1:
+            # like the built-in server, the index is what tells the mirror which files changed
+            index: dict[str, str] = {k: f'"{k}-{get_version(f"/mirror/{k}")}"' for k in _fixtures}
+            self.send_body(200, json.dumps(index).encode(), 'application/json')
+        elif parts[0] == 'mirror' and len(parts) == 2:
+            self.send_fixture(url.path, parts[1], bump=False)
+        else:
+            self.send_body(404, b'', 'text/plain')
+
+    def send_fixture(self, key: str, name: str, xrate: bool = False, bump: bool = True) -> None:
+        if name not in _fixtures:
+            self.send_body(404, b'', 'text/plain')
+            return
+
+        version: int = get_version(key, bump)
+        etag: str = f'"{name}-{version}"'
+
+        if self.headers.get('if-none-match') == etag:
+            with _standin_lock:
+                _stats['not_modified'] += 1
+            self.send_body(304, b'', None, etag, xrate)
+        else:
+            body: bytes = get_body(name, version)
+            self.send_body(200, body, s2olib.server.guess_content_type(name, body), etag, xrate)
+
+    def send_body(self, status: int, body: bytes, content_type: str | None, etag: str | None = None, xrate: bool = False) -> None:
+        self.send_response(status)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        if etag:
+            self.send_header('ETag', etag)
+        if xrate:
+            with _standin_lock:
+                self.send_header('X-RateLimit-Limit', str(STANDIN_RATE_LIMIT))
+                self.send_header('X-RateLimit-Remaining', str(max(0, STANDIN_RATE_LIMIT - _stats['requests'])))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        with _standin_lock:
+            _stats['bytes'] += len(body)
+            if status >= 500:
+                _stats['errors'] += 1
+
+    def log_message(self, format: str, *args: any) -> None:
+        pass
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def point_to_standin(args: argparse.Namespace, tool: str, base_url: str) -> None:
+    module = importlib.import_module(f's2olib.{tool}')
+
+    if tool == 'apod':
+        module.API_URL_TPL = f'{base_url}/apod?count={{count}}&api_key={{nasa_api_key}}'
+    elif tool == 'dnmap':
+        module.IMAGE_URL_TPL = f'{base_url}/dnmap?iso={{iso}}&earth={{earth}}'
+    elif tool == 'eonet':
+        module.API_URL_TPL = f'{base_url}/eonet?status={{status}}&limit={{limit}}'
+        module.API_INCREMENTAL_URL_TPL = f'{base_url}/eonet?status=all&start={{start}}&end={{end}}'
+    elif tool == 'soho':
+        module.CAMERAS = {id: (cam[0], f'{base_url}/soho/{id}') if cam else cam for id, cam in module.CAMERAS.items()}
+    elif tool == 'mirror':
+        args.mirror_upstream = f'{base_url}/mirror'
+
+
+def bench_tool(args: argparse.Namespace, tool: str, base_url: str) -> dict[str, any]:
+    # runs in its own process, so the peak memory usage belongs to this tool alone
+    module = importlib.import_module(f's2olib.{tool}')
+    point_to_standin(args, tool, base_url)
+
+    writes: list[pathlib.Path] = []
+    s2olib.shared.add_publish_hook(writes.append)
+    s2olib.shared.setup_session(args.pool_size, args.max_retries)
+
+    with tempfile.TemporaryDirectory() as tmp_dir, open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        args.cache_dir = pathlib.Path(tmp_dir) / 'cache'
+        args.cache_dir.mkdir()
+        args.secrets_file = pathlib.Path(tmp_dir) / 'secrets.json'
+        args.secrets_file.write_text(json.dumps({'nasa_api_key': 'DEMO_KEY'}))
+
+        state: dict[str, any] = module.setup(args)
+        started: float = time.perf_counter()
+
+        # the returned delays are ignored, every cycle runs right away
+        for _ in range(args.cycles):
+            if hasattr(module, 'poll_now'):
+                module.poll_now(args, state)
+            module.run(args, state)
+
+        # variants are part of the work, and their files must be written before the cache is removed
+        s2olib.variants.shutdown()
+        seconds: float = time.perf_counter() - started
+
+    return {
+        'tool': tool,
+        'cycles': args.cycles,
+        'seconds': seconds,
+        'writes': len(writes),
+        'peak_rss': get_peak_rss(),
+    }
+
+
+def get_peak_rss() -> int | None:
+    if resource is None:
+        return None
+
+    # bytes on macos, kilobytes everywhere else
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def format_result(result: dict[str, any]) -> str:
+    peak_rss: str = f'{result["peak_rss"] / 1024 / 1024:.1f}' if result['peak_rss'] is not None else '?'
+
+    return f'{result["tool"]:<8} {result["cycles"] / max(result["seconds"], 1e-9):>10.1f} {result["requests"]:>9} {result["not_modified"]:>6} {result["errors"]:>7} {result["bytes"] / 1024 / 1024:>9.2f} {result["writes"]:>7} {peak_rss:>9}'
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(**ARGPARSER_SETUP)
+
+    s2olib.shared.add_args(dest=argparser, args=[s2olib.shared.ARG_TOOL])
+    s2olib.shared.add_args(dest=argparser.add_argument_group(title='benchmark options'), args=ARGS)
+
+    for v in s2olib.shared.get_arg_groups(sys.argv[1:]):
+        group = argparser.add_argument_group(title=v[0])
+        s2olib.shared.add_args(dest=group, args=v[1])
+
+    if len(sys.argv) == 1:
+        argparser.print_help()
+        exit(0)
+
+    args = argparser.parse_args()
+
+    try:
+        args.image_variants = s2olib.variants.parse_specs(args.image_variants)
+    except ValueError as e:
+        s2olib.shared.msg(str(e))
+        exit(1)
+
+    # no idle time and no waiting for the request budget, only the work itself is measured
+    args.interval = 0
+    args.retry_delay = 0
+    args.tool_interval = {}
+    args.tool_retry_delay = {}
+    args.adaptive_interval = False
+    args.rate_limit = STANDIN_RATE_LIMIT
+
+    tools: list[str] = s2olib.shared.get_tools(args.tool)
+    base_url: str = start_standin(args)
+    results: list[dict[str, any]] = []
+
+    s2olib.shared.msg(f'-=[ space2obs benchmark :: {", ".join(tools)} ]=-', plain=True, end='\n\n')
+    s2olib.shared.msg(f'{args.cycles} cycles, {args.latency} ms latency, error rate {args.error_rate}, change rate {args.change_rate}, seed {args.seed}', plain=True, end='\n\n')
+    s2olib.shared.msg(f'{"tool":<8} {"cycles/s":>10} {"requests":>9} {"304s":>6} {"errors":>7} {"MB":>9} {"writes":>7} {"peak MB":>9}', plain=True)
+
+    try:
+        for tool in tools:
+            before: dict[str, int] = get_snapshot()
+
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                result: dict[str, any] = pool.submit(bench_tool, args, tool, base_url).result()
+
+            result.update({k: v - before[k] for k, v in get_snapshot().items()})
+            results.append(result)
+
+            s2olib.shared.msg(format_result(result), plain=True)
+    except KeyboardInterrupt:
+        s2olib.shared.msg('[quit]', start='\n')
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=4))
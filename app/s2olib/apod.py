@@ -1,20 +1,30 @@
 import argparse
+import collections.abc
+import json
+import logging
+import os
 import pathlib
-import re
 import textwrap
+import time
 
 import s2olib.shared
+import s2olib.variants
 
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 
 DEFAULT_MAX_EXPLANATION_LENGTH: int = 600
+DEFAULT_PREFETCH: int = 10
+DEFAULT_LOW_WATER: int = 2
 DEFAULT_TEXT_TPL: str = '{title}\\n\\n{explanation}\\n\\n[ {copyright} | apod.nasa.gov | {date} ]' # escape \n here in the template... e.g. \n -> \\n
 
-TEXT_TPL_VARS: list[str] = re.findall('({[a-z]+})', DEFAULT_TEXT_TPL)
+TEXT_VARS: list[str] = ['title', 'explanation', 'copyright', 'date']
+TEXT_TPL_VARS: list[str] = [f'{{{v}}}' for v in TEXT_VARS]
 
-API_URL_TPL: str = 'https://api.nasa.gov/planetary/apod?count=1&api_key={nasa_api_key}'
+API_URL_TPL: str = 'https://api.nasa.gov/planetary/apod?count={count}&api_key={nasa_api_key}'
+
+QUEUE_DIR_NAME: str = 'apod_queue'
 
 ENTRY_FUNC: str = 'daemon'
 
@@ -33,6 +43,28 @@ ARGS: list[dict[str, any]] = [
         'default': DEFAULT_TEXT_TPL,
         'help': f'Specify the template for the text file. Add linebreaks with "\\n". Variables: {", ".join(TEXT_TPL_VARS)}. Default: {DEFAULT_TEXT_TPL}'
     },
+    {
+        'name_or_flags': ['--apod-prefetch'],
+        'metavar': 'NUM',
+        'type': int,
+        'default': DEFAULT_PREFETCH,
+        'help': f'Set how many pictures to request at once and keep downloaded in the queue, one of them is shown per interval. Default: {DEFAULT_PREFETCH}'
+    },
+    {
+        'name_or_flags': ['--apod-low-water'],
+        'metavar': 'NUM',
+        'type': int,
+        'default': DEFAULT_LOW_WATER,
+        'help': f'Request new pictures once fewer than this many are left in the queue, right after one is shown. Default: {DEFAULT_LOW_WATER}'
+    },
+    {
+        'name_or_flags': ['--apod-text-outputs'],
+        'metavar': 'NAME:TEXT',
+        'type': str,
+        'nargs': '+',
+        'default': [],
+        'help': f'Additionally write the text with other templates to apod_last_NAME_text files, e.g. title:{{title}}. Variables: {", ".join(TEXT_TPL_VARS)}. Default: none'
+    },
 ]
 
 
@@ -40,65 +72,156 @@ ARGS: list[dict[str, any]] = [
 
 
 def daemon(args: argparse.Namespace):
+    s2olib.shared.run_tools(args, ['apod'])
+
+
+def setup(args: argparse.Namespace) -> dict[str, any]:
     secrets = s2olib.shared.get_secrets(args.secrets_file, ['nasa_api_key'])
-    api_url = API_URL_TPL.format(**secrets)
-    obs_data_file: pathlib.Path = args.cache_dir / 'apod_last_data'
-    obs_image_file: pathlib.Path = args.cache_dir / 'apod_last_image'
-    obs_text_file: pathlib.Path = args.cache_dir / 'apod_last_text'
-    last_content_size: int = obs_data_file.stat().st_size if obs_data_file.is_file() else 0
-
-    while True:
-        s2olib.shared.msg('downloading data')
-        res = s2olib.shared.fetch_remote_data(api_url, args.request_timeout, ['application/json'])
-
-        if not res:
-            s2olib.shared.msg('invalid response data')
-            s2olib.shared.retry_idle(args.retry_delay)
-            continue
+    queue_dir: pathlib.Path = args.cache_dir / QUEUE_DIR_NAME
+    queue_dir.mkdir(exist_ok=True)
 
-        if len(res.content) == last_content_size:
-            s2olib.shared.msg('same as before')
-            s2olib.shared.endofloop_idle(args.interval)
-            continue
+    try:
+        template: collections.abc.Callable[[dict[str, any]], str] = s2olib.shared.compile_template(args.apod_text_template, TEXT_VARS)
+        outputs: list[dict[str, any]] = s2olib.shared.parse_text_outputs(args.cache_dir, 'apod', args.apod_text_outputs, TEXT_VARS)
+    except ValueError as e:
+        s2olib.shared.msg(str(e), level=logging.ERROR)
+        exit(1)
+
+    return {
+        'api_url': API_URL_TPL.format(count=max(1, args.apod_prefetch), **secrets),
+        'queue_dir': queue_dir,
+        'obs_data_file': args.cache_dir / 'apod_last_data',
+        'obs_image_file': args.cache_dir / 'apod_last_image',
+        'obs_text_file': args.cache_dir / 'apod_last_text',
+        'template': template,
+        'outputs': outputs,
+        # a poll only tops up the queue, the picture shown stays until its time is up
+        'next_swap': 0.0,
+        'poll': False,
+    }
+
+
+def run(args: argparse.Namespace, state: dict[str, any]) -> int:
+    obs_data_file: pathlib.Path = state['obs_data_file']
+    obs_image_file: pathlib.Path = state['obs_image_file']
+    obs_text_file: pathlib.Path = state['obs_text_file']
+
+    queue: list[pathlib.Path] = get_queue(state['queue_dir'])
+
+    if state['poll'] and state['next_swap'] > time.time():
+        state['poll'] = False
+        s2olib.shared.msg(f'{top_up(args, state, len(queue))} pictures left in the queue')
+        return max(0.0, state['next_swap'] - time.time())
+
+    state['poll'] = False
+
+    # only an empty queue is filled before showing a picture, otherwise that happens after the swap
+    if not queue:
+        wait: float = s2olib.shared.acquire_rate_limit(args.cache_dir, args.rate_limit)
+        if wait:
+            return wait
+        queue = fill_queue(args, state)
+
+    if not queue:
+        return s2olib.shared.retry_later(args, 'apod')
+
+    queued_data_file: pathlib.Path = queue[0]
+    queued_image_file: pathlib.Path = queued_data_file.with_name(queued_data_file.name.replace('_data', '_image'))
+    data: dict[str, any] = s2olib.shared.read_json_file(queued_data_file, {})
 
-        dump: list | dict = res.json()
-        data: dict = dump[0] if dump and type(dump) == list else {}
+    s2olib.shared.msg(f'updating {obs_image_file.name}')
+    os.replace(queued_image_file, obs_image_file)
+    queued_state: dict[str, any] = s2olib.shared.get_fetch_state(queued_image_file)
+    s2olib.shared.update_fetch_state(obs_image_file, {'hash': queued_state.get('hash'), 'image': queued_state.get('image')})
+    s2olib.shared.remove_fetch_state(queued_image_file)
+    s2olib.shared.publish(obs_image_file)
+    s2olib.variants.update(args, obs_image_file)
 
-        s2olib.shared.check_xrate(res)
+    s2olib.shared.msg(f'updating {obs_data_file.name}')
+    s2olib.shared.write_file(obs_data_file, json.dumps([data]).encode())
 
-        if data.get('media_type', None) != 'image':
-            s2olib.shared.msg(f"skipping media type '{data.get('media_type')}'")
-            s2olib.shared.retry_idle(args.retry_delay)
+    values: dict[str, str] = get_text_values(args, data)
+    s2olib.shared.write_text_file(obs_text_file, state['template'](values))
+
+    for output in state['outputs']:
+        s2olib.shared.write_text_file(output['text_file'], output['template'](values))
+
+    queued_data_file.unlink()
+    s2olib.shared.msg(f'{top_up(args, state, len(queue) - 1)} pictures left in the queue')
+
+    state['next_swap'] = time.time() + s2olib.shared.get_interval(args, 'apod')
+
+    return s2olib.shared.get_interval(args, 'apod')
+
+
+def snapshot(args: argparse.Namespace, state: dict[str, any]) -> dict[str, any]:
+    # the queue itself stays in the queue directory
+    return {'queue': [v.name for v in get_queue(state['queue_dir'])], 'next_swap': state['next_swap']}
+
+
+def restore(args: argparse.Namespace, state: dict[str, any], saved: dict[str, any]) -> None:
+    state['next_swap'] = s2olib.shared.get_resume_time(args, 'apod', saved.get('next_swap', 0.0))
+
+
+def poll_now(args: argparse.Namespace, state: dict[str, any]) -> None:
+    state['poll'] = True
+
+
+def top_up(args: argparse.Namespace, state: dict[str, any], left: int) -> int:
+    # topped up while there are still pictures to show, so no rotation has to wait for the downloads
+    if left < max(1, args.apod_low_water) and not s2olib.shared.acquire_rate_limit(args.cache_dir, args.rate_limit):
+        left = len(fill_queue(args, state))
+
+    return left
+
+
+def get_queue(queue_dir: pathlib.Path) -> list[pathlib.Path]:
+    # an entry only counts once both its data and its image are in place
+    return [v for v in sorted(queue_dir.glob('*_data')) if v.with_name(v.name.replace('_data', '_image')).is_file()]
+
+
+def fill_queue(args: argparse.Namespace, state: dict[str, any]) -> list[pathlib.Path]:
+    queue_dir: pathlib.Path = state['queue_dir']
+
+    s2olib.shared.msg(f'downloading data for {max(1, args.apod_prefetch)} pictures', level=logging.DEBUG)
+    res: s2olib.shared.RemoteData | None = s2olib.shared.fetch_remote_data(state['api_url'], args.request_timeout, ['application/json'], max_size_mb=args.max_download_size)
+
+    if not res:
+        s2olib.shared.msg('invalid response data', level=logging.WARNING)
+        return get_queue(queue_dir)
+
+    s2olib.shared.check_xrate(res.res, args.cache_dir)
+
+    dump: list | dict = res.json()
+    # entries of earlier batches may still be queued, new ones are sorted behind them
+    batch: str = f'{time.time_ns()}'
+
+    for i, data in enumerate(dump if type(dump) == list else []):
+        if data.get('media_type', None) != 'image' or not data.get('url', None):
+            s2olib.shared.msg(f"skipping media type '{data.get('media_type')}'", level=logging.DEBUG)
             continue
 
         if 'tomorrow\'s picture:' in data.get('explanation', '').lower():
-            s2olib.shared.msg(f"skipping bad data '{data['explanation'][0:30]}...'")
-            s2olib.shared.retry_idle(args.retry_delay)
+            s2olib.shared.msg(f"skipping bad data '{data['explanation'][0:30]}...'", level=logging.DEBUG)
             continue
 
-        last_content_size = len(res.content)
-
-        s2olib.shared.msg(f'updating {obs_data_file.name}')
-        obs_data_file.write_bytes(res.content)
+        name: str = f'{batch}{i:04d}'
+        queued_image_file: pathlib.Path = queue_dir / f'{name}_image'
 
-        s2olib.shared.msg('downloading image')
-        image_url = data.get('url', None)
-        res = s2olib.shared.fetch_remote_data(image_url, args.request_timeout, ['image/jpeg', 'image/png', 'image/gif'])
-        if not res:
-            s2olib.shared.msg('download failed')
-            s2olib.shared.retry_idle(args.retry_delay)
+        s2olib.shared.msg(f'downloading image {data["url"]}', level=logging.DEBUG)
+        if s2olib.shared.download_remote_file(data['url'], args.request_timeout, ['image/jpeg', 'image/png', 'image/gif'], queued_image_file, args.max_download_size) is None:
+            s2olib.shared.msg('download failed', level=logging.WARNING)
             continue
 
-        s2olib.shared.msg(f'updating {obs_image_file.name}')
-        obs_image_file.write_bytes(res.content)
+        s2olib.shared.replace_file(queue_dir / f'{name}_data', json.dumps(data).encode())
+
+    return get_queue(queue_dir)
 
-        s2olib.shared.msg(f'updating {obs_text_file.name}')
-        text: str = args.apod_text_template.replace('\\n', '\n').format(
-            date=s2olib.shared.megastrip(data.get('date', '?')),
-            title=s2olib.shared.megastrip(data.get('title', '?')),
-            copyright=s2olib.shared.megastrip(data.get('copyright', '?')),
-            explanation=textwrap.shorten(s2olib.shared.megastrip(data.get('explanation', '')), args.apod_max_explanation_length),
-        )
-        obs_text_file.write_text(text)
 
-        s2olib.shared.endofloop_idle(args.interval)
+def get_text_values(args: argparse.Namespace, data: dict[str, any]) -> dict[str, str]:
+    return {
+        'date': s2olib.shared.megastrip(data.get('date', '?')),
+        'title': s2olib.shared.megastrip(data.get('title', '?')),
+        'copyright': s2olib.shared.megastrip(data.get('copyright', '?')),
+        'explanation': textwrap.shorten(s2olib.shared.megastrip(data.get('explanation', '')), args.apod_max_explanation_length),
+    }
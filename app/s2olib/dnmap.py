@@ -1,8 +1,13 @@
 import argparse
 import datetime
+import importlib.util
+import io
+import logging
+import math
 import pathlib
 
 import s2olib.shared
+import s2olib.variants
 
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -10,6 +15,16 @@ import s2olib.shared
 
 IMAGE_URL_TPL: str = 'https://www.timeanddate.com/scripts/sunmap.php?iso={iso}&earth={earth}'
 
+DEFAULT_LOCAL_QUALITY: int = 90
+
+# sun elevation in degrees where each twilight band starts and how much daylight it shows
+TWILIGHT_BANDS: list[tuple[float, float]] = [
+    (0.0, 1.0),
+    (-6.0, 0.7),   # civil
+    (-12.0, 0.45), # nautical
+    (-18.0, 0.2),  # astronomical
+]
+
 ENTRY_FUNC: str = 'daemon'
 
 ARGS: list[dict[str, any]] = [
@@ -18,7 +33,27 @@ ARGS: list[dict[str, any]] = [
         'action': 'store_true',
         'default': False,
         'help': 'Download the simple version of the map image. Default: download the satellite version'
-    }
+    },
+    {
+        'name_or_flags': ['--dnmap-local'],
+        'action': 'store_true',
+        'default': False,
+        'help': 'Render the map locally from --dnmap-day-map and --dnmap-night-map instead of downloading it. Requires numpy and Pillow. Default: download the map'
+    },
+    {
+        'name_or_flags': ['--dnmap-day-map'],
+        'metavar': 'PATH',
+        'type': pathlib.Path,
+        'default': None,
+        'help': 'Specify the daytime base map image (equirectangular, -180..180 longitude, 90..-90 latitude) for --dnmap-local. Default: none'
+    },
+    {
+        'name_or_flags': ['--dnmap-night-map'],
+        'metavar': 'PATH',
+        'type': pathlib.Path,
+        'default': None,
+        'help': 'Specify the nighttime base map image for --dnmap-local, it is scaled to the size of the day map. Default: none'
+    },
 ]
 
 
@@ -26,24 +61,121 @@ ARGS: list[dict[str, any]] = [
 
 
 def daemon(args: argparse.Namespace):
-    obs_image_file: pathlib.Path = args.cache_dir / 'dnmap_last_image'
-    last_content_size: int = obs_image_file.stat().st_size if obs_image_file.is_file() else 0
-
-    while True:
-        img_url = IMAGE_URL_TPL.format(iso=datetime.datetime.now(tz=datetime.timezone.utc).strftime("%Y%m%dT%H%M"), earth='0' if args.dnmap_simple else '1')
-
-        s2olib.shared.msg('downloading image')
-        res = s2olib.shared.fetch_remote_data(img_url, args.request_timeout, ['image/jpeg'])
-        if not res:
-            s2olib.shared.msg('invalid response data')
-            s2olib.shared.retry_idle(args.retry_delay)
-            continue
-
-        if len(res.content) == last_content_size:
-            s2olib.shared.msg('no change')
-        else:
-            s2olib.shared.msg(f'updating {obs_image_file.name}')
-            obs_image_file.write_bytes(res.content)
-            last_content_size = len(res.content)
-
-        s2olib.shared.endofloop_idle(args.interval)
+    s2olib.shared.run_tools(args, ['dnmap'])
+
+
+def setup(args: argparse.Namespace) -> dict[str, any]:
+    state: dict[str, any] = {
+        'obs_image_file': args.cache_dir / 'dnmap_last_image',
+    }
+
+    if args.dnmap_local:
+        state.update(setup_local(args))
+
+    return state
+
+
+def run(args: argparse.Namespace, state: dict[str, any]) -> int:
+    if args.dnmap_local:
+        return run_local(args, state)
+
+    obs_image_file: pathlib.Path = state['obs_image_file']
+    img_url = IMAGE_URL_TPL.format(iso=datetime.datetime.now(tz=datetime.timezone.utc).strftime("%Y%m%dT%H%M"), earth='0' if args.dnmap_simple else '1')
+
+    s2olib.shared.msg('downloading image', level=logging.DEBUG)
+    updated = s2olib.shared.download_remote_file(img_url, args.request_timeout, ['image/jpeg'], obs_image_file, args.max_download_size)
+    if updated is None:
+        s2olib.shared.msg('invalid response data', level=logging.WARNING)
+        return s2olib.shared.retry_later(args, 'dnmap')
+
+    s2olib.shared.msg(f'updated {obs_image_file.name}' if updated else 'no change', level=logging.INFO if updated else logging.DEBUG)
+    s2olib.variants.update(args, obs_image_file)
+
+    return s2olib.shared.get_next_delay(args, 'dnmap', obs_image_file, updated)
+
+
+def setup_local(args: argparse.Namespace) -> dict[str, any]:
+    # numpy and Pillow are only imported when the map is rendered locally
+    if importlib.util.find_spec('numpy') is None or importlib.util.find_spec('PIL') is None:
+        s2olib.shared.msg('missing modules for --dnmap-local: numpy <https://numpy.org> and Pillow <https://python-pillow.org>', level=logging.ERROR)
+        exit(1)
+
+    for v in [args.dnmap_day_map, args.dnmap_night_map]:
+        if not v or not v.is_file():
+            s2olib.shared.msg(f'--dnmap-local needs both --dnmap-day-map and --dnmap-night-map to point to a file: {v}', level=logging.ERROR)
+            exit(1)
+
+    import numpy # https://numpy.org
+    import PIL.Image # https://python-pillow.org
+
+    day_map = PIL.Image.open(args.dnmap_day_map).convert('RGB')
+    night_map = PIL.Image.open(args.dnmap_night_map).convert('RGB').resize(day_map.size)
+    width, height = day_map.size
+
+    # the grids only depend on the map size, so they are computed once and reused for every frame
+    lat = numpy.radians(90.0 - (numpy.arange(height, dtype=numpy.float32) + 0.5) * 180.0 / height)[:, numpy.newaxis]
+    lon = numpy.radians((numpy.arange(width, dtype=numpy.float32) + 0.5) * 360.0 / width - 180.0)[numpy.newaxis, :]
+
+    return {
+        'day': numpy.asarray(day_map, dtype=numpy.float32),
+        'night': numpy.asarray(night_map, dtype=numpy.float32),
+        'sin_lat': numpy.sin(lat),
+        'cos_lat': numpy.cos(lat),
+        'lon': lon,
+    }
+
+
+def run_local(args: argparse.Namespace, state: dict[str, any]) -> int:
+    import numpy
+    import PIL.Image
+
+    obs_image_file: pathlib.Path = state['obs_image_file']
+
+    s2olib.shared.msg('rendering image', level=logging.DEBUG)
+    sub_lat, sub_lon = get_subsolar_point(datetime.datetime.now(tz=datetime.timezone.utc))
+
+    # sine of the sun elevation for every pixel
+    sin_elevation = state['sin_lat'] * math.sin(sub_lat) + state['cos_lat'] * math.cos(sub_lat) * numpy.cos(state['lon'] - sub_lon)
+
+    daylight = numpy.zeros(sin_elevation.shape, dtype=numpy.float32)
+    for elevation, amount in reversed(TWILIGHT_BANDS):
+        daylight[sin_elevation >= math.sin(math.radians(elevation))] = amount
+
+    daylight = daylight[..., numpy.newaxis]
+    pixels = state['night'] + (state['day'] - state['night']) * daylight
+
+    buffer = io.BytesIO()
+    PIL.Image.fromarray(pixels.astype(numpy.uint8)).save(buffer, format='JPEG', quality=DEFAULT_LOCAL_QUALITY)
+
+    content_hash = s2olib.shared.new_content_hash()
+    content_hash.update(buffer.getvalue())
+    updated: bool = content_hash.hexdigest() != s2olib.shared.get_content_hash(obs_image_file)
+
+    if updated:
+        s2olib.shared.msg(f'updating {obs_image_file.name}')
+        s2olib.shared.write_file(obs_image_file, buffer.getvalue())
+        s2olib.shared.update_fetch_state(obs_image_file, {'hash': content_hash.hexdigest()})
+    else:
+        s2olib.shared.msg('no change', level=logging.DEBUG)
+
+    s2olib.variants.update(args, obs_image_file)
+
+    return s2olib.shared.get_interval(args, 'dnmap')
+
+
+def get_subsolar_point(now: datetime.datetime) -> tuple[float, float]:
+    # low precision solar position, good to about a hundredth of a degree, returns (lat, lon) in radians
+    n: float = (now - datetime.datetime(2000, 1, 1, 12, tzinfo=datetime.timezone.utc)).total_seconds() / 86400.0
+
+    mean_longitude: float = math.radians((280.460 + 0.9856474 * n) % 360)
+    mean_anomaly: float = math.radians((357.528 + 0.9856003 * n) % 360)
+    ecliptic_longitude: float = mean_longitude + math.radians(1.915 * math.sin(mean_anomaly) + 0.020 * math.sin(2 * mean_anomaly))
+    obliquity: float = math.radians(23.439 - 0.0000004 * n)
+
+    declination: float = math.asin(math.sin(obliquity) * math.sin(ecliptic_longitude))
+    right_ascension: float = math.atan2(math.cos(obliquity) * math.sin(ecliptic_longitude), math.cos(ecliptic_longitude))
+    sidereal_time: float = math.radians((280.46061837 + 360.98564736629 * n) % 360)
+
+    lon: float = (right_ascension - sidereal_time + math.pi) % (2 * math.pi) - math.pi
+
+    return declination, lon
@@ -1,6 +1,10 @@
 import argparse
+import collections.abc
+import datetime
+import logging
+import math
 import pathlib
-import re
+import time
 
 import s2olib.shared
 
@@ -9,14 +13,23 @@ import s2olib.shared
 
 
 API_URL_TPL: str = 'https://eonet.gsfc.nasa.gov/api/v3/events?status={status}&limit={limit}'
+API_INCREMENTAL_URL_TPL: str = 'https://eonet.gsfc.nasa.gov/api/v3/events?status=all&start={start}&end={end}'
+
+INDEX_FILE_NAME: str = 'eonet_index'
 
 STATUS_CHOICES: list[str] = ['all', 'open', 'closed']
 
 DEFAULT_STATUS: str = 'all'
 DEFAULT_LIMIT: int = 50
 DEFAULT_TEXT_TPL: str = '{status:>6}  {date}  {id}  {categories}:  {title}' # this is a line of the output list, escape \n here in the template... e.g. \n -> \\n
+DEFAULT_PAGE_SIZE: int = 0
+DEFAULT_PAGE_INTERVAL: int = 15
+
+TEXT_VARS: list[str] = ['status', 'date', 'id', 'categories', 'title']
+TEXT_TPL_VARS: list[str] = [f'{{{v}}}' for v in TEXT_VARS]
 
-TEXT_TPL_VARS: list[str] = re.findall('({[a-z]+})', DEFAULT_TEXT_TPL)
+GRID_CELL_SIZE: float = 5.0 # degrees
+EARTH_RADIUS: float = 6371.0 # km
 
 ENTRY_FUNC: str = 'daemon'
 
@@ -43,6 +56,34 @@ ARGS: list[dict[str, any]] = [
         'default': DEFAULT_TEXT_TPL,
         'help': f'Specify the template of a line in the text file. Add linebreaks with "\\n". Variables: {", ".join(TEXT_TPL_VARS)}. Default: {DEFAULT_TEXT_TPL}'
     },
+    {
+        'name_or_flags': ['--eonet-incremental'],
+        'action': 'store_true',
+        'default': False,
+        'help': 'Keep a local index of events and only fetch events that changed since the last run. Default: fetch the full list every time',
+    },
+    {
+        'name_or_flags': ['--eonet-feeds'],
+        'metavar': 'SPEC',
+        'type': str,
+        'nargs': '+',
+        'default': [],
+        'help': 'Additionally write the events matching some filters to their own text files eonet_last_NAME_text. Format: NAME[:bbox=WEST,SOUTH,EAST,NORTH][:near=LAT,LON,KM][:cat=CATEGORY,...][:tpl=TEMPLATE], e.g. europe:bbox=-25,34,45,72 fires:cat=wildfires,volcanoes:tpl={date} {title}. Default: none',
+    },
+    {
+        'name_or_flags': ['--eonet-page-size'],
+        'metavar': 'NUM',
+        'type': int,
+        'default': DEFAULT_PAGE_SIZE,
+        'help': f'Split the text file into pages of this many events and show one page after the other. Default: {DEFAULT_PAGE_SIZE} (all events at once)',
+    },
+    {
+        'name_or_flags': ['--eonet-page-interval'],
+        'metavar': 'SEC',
+        'type': int,
+        'default': DEFAULT_PAGE_INTERVAL,
+        'help': f'Set how many seconds each page is shown with --eonet-page-size. Default: {DEFAULT_PAGE_INTERVAL}',
+    },
 ]
 
 
@@ -50,43 +91,363 @@ ARGS: list[dict[str, any]] = [
 
 
 def daemon(args: argparse.Namespace):
-    api_url = API_URL_TPL.format(status=args.eonet_status, limit=args.eonet_limit)
-    obs_data_file: pathlib.Path = args.cache_dir / 'eonet_last_data'
-    obs_text_file: pathlib.Path = args.cache_dir / 'eonet_last_text'
-    last_content_size: int = obs_data_file.stat().st_size if obs_data_file.is_file() else 0
-
-    while True:
-        s2olib.shared.msg(f'downloading events')
-        res = s2olib.shared.fetch_remote_data(api_url, args.request_timeout, ['application/json'])
-
-        if not res:
-            s2olib.shared.msg('invalid response data')
-            s2olib.shared.retry_idle(args.retry_delay)
-            continue
+    s2olib.shared.run_tools(args, ['eonet'])
+
+
+def setup(args: argparse.Namespace) -> dict[str, any]:
+    try:
+        template: collections.abc.Callable[[dict[str, any]], str] = s2olib.shared.compile_template(args.eonet_text_template, TEXT_VARS)
+        feeds: list[dict[str, any]] = parse_feeds(args, args.eonet_feeds)
+    except ValueError as e:
+        s2olib.shared.msg(str(e), level=logging.ERROR)
+        exit(1)
+
+    return {
+        'api_url': API_URL_TPL.format(status=args.eonet_status, limit=args.eonet_limit),
+        'obs_data_file': args.cache_dir / 'eonet_last_data',
+        'obs_text_file': args.cache_dir / 'eonet_last_text',
+        'index_file': args.cache_dir / INDEX_FILE_NAME,
+        # kept in memory between the polls, the index file is only written when it changed
+        'index': load_index(args, args.cache_dir / INDEX_FILE_NAME) if args.eonet_incremental else None,
+        'template': template,
+        'feeds': feeds,
+        # the outputs are written once after starting even if nothing changed, so new settings show up right away
+        'outputs_ready': False,
+        'next_poll': 0.0,
+        'pages': [],
+        'page': 0,
+        'page_interval': max(1, args.eonet_page_interval),
+        'next_page': 0.0,
+    }
+
+
+def run(args: argparse.Namespace, state: dict[str, any]) -> float:
+    # pages are shown in between the polls, from what the last poll rendered
+    if state['next_poll'] <= time.time():
+        state['next_poll'] = time.time() + poll(args, state)
+    elif not state['outputs_ready']:
+        # resumed from a snapshot, the last download is shown until the next poll is due,
+        # nothing is written if there is none
+        records: dict[str, dict[str, any]] = load_records(args, state)
+        if records:
+            update_outputs(args, state, records)
+
+    if not state['pages']:
+        return max(0.0, state['next_poll'] - time.time())
+
+    if state['next_page'] <= time.time():
+        show_page(state, state['page'] + 1)
+
+    return max(0.0, min(state['next_poll'], state['next_page']) - time.time())
+
+
+def poll(args: argparse.Namespace, state: dict[str, any]) -> float:
+    obs_data_file: pathlib.Path = state['obs_data_file']
+    index: dict[str, any] | None = state['index']
+    today: datetime.date = datetime.datetime.now(tz=datetime.timezone.utc).date()
+
+    api_url: str = state['api_url']
+    if index and index.get('watermark'):
+        api_url = API_INCREMENTAL_URL_TPL.format(start=index['watermark'], end=today + datetime.timedelta(days=1))
+
+    wait: float = s2olib.shared.acquire_rate_limit(args.cache_dir, args.rate_limit)
+    if wait:
+        return wait
+
+    s2olib.shared.msg(f'downloading events', level=logging.DEBUG)
+    res: s2olib.shared.RemoteData | None = s2olib.shared.fetch_remote_data(api_url, args.request_timeout, ['application/json'], obs_data_file, args.max_download_size)
 
-        s2olib.shared.check_xrate(res)
+    if not res:
+        s2olib.shared.msg('invalid response data', level=logging.WARNING)
+        return s2olib.shared.retry_later(args, 'eonet')
 
+    s2olib.shared.check_xrate(res.res, args.cache_dir)
+
+    changed: bool = not s2olib.shared.is_unchanged(res, obs_data_file)
+
+    records: dict[str, dict[str, any]] | None = None
+    merged: bool = False
+
+    if not changed:
+        s2olib.shared.msg('no change', level=logging.DEBUG)
+    else:
         data: dict[str, any] = res.json()
 
-        if len(res.content) == last_content_size:
-            s2olib.shared.msg('no change')
+        s2olib.shared.msg(f'updating {obs_data_file.name}')
+        s2olib.shared.write_cache_file(obs_data_file, res)
+
+        if index is None:
+            records = {event['id']: make_record(state['template'], event) for event in data['events']}
+        else:
+            merge_index(args, state['template'], index, data['events'])
+            records = index['events']
+            merged = True
+
+    if records is None and not state['outputs_ready']:
+        records = index['events'] if index is not None else load_records(args, state)
+
+    if records is not None:
+        update_outputs(args, state, records)
+
+    # dates are all the api can filter on, so the next run starts at the beginning of today
+    if index is not None and (merged or index['watermark'] != str(today)):
+        index['watermark'] = str(today)
+        s2olib.shared.write_json_file(state['index_file'], index)
+
+    return s2olib.shared.get_next_delay(args, 'eonet', obs_data_file, changed)
+
+
+def snapshot(args: argparse.Namespace, state: dict[str, any]) -> dict[str, any]:
+    # the index and its watermark stay in the index file
+    return {'next_poll': state['next_poll']}
+
+
+def restore(args: argparse.Namespace, state: dict[str, any], saved: dict[str, any]) -> None:
+    state['next_poll'] = s2olib.shared.get_resume_time(args, 'eonet', saved.get('next_poll', 0.0))
+
+
+def poll_now(args: argparse.Namespace, state: dict[str, any]) -> None:
+    state['next_poll'] = 0.0
+
+
+def load_records(args: argparse.Namespace, state: dict[str, any]) -> dict[str, dict[str, any]]:
+    if args.eonet_incremental:
+        return state['index']['events']
+
+    return {event['id']: make_record(state['template'], event) for event in s2olib.shared.read_json_file(state['obs_data_file'], {'events': []})['events']}
+
+
+def update_outputs(args: argparse.Namespace, state: dict[str, any], records: dict[str, dict[str, any]]) -> None:
+    lines: list[str] = [v['line'] for v in records.values()]
+
+    if args.eonet_page_size > 0:
+        state['pages'] = ['\n'.join(lines[i:i + args.eonet_page_size]) for i in range(0, len(lines), args.eonet_page_size)] or ['']
+        # stay on the current page, the next one follows at the usual time
+        if state['next_page'] and state['page'] < len(state['pages']):
+            write_page(state)
         else:
-            s2olib.shared.msg(f'updating {obs_data_file.name}')
-            obs_data_file.write_bytes(res.content)
-            last_content_size = len(res.content)
+            show_page(state, state['page'] if state['page'] < len(state['pages']) else 0)
+    else:
+        s2olib.shared.write_text_file(state['obs_text_file'], '\n'.join(lines))
+
+    update_feeds(args, state['feeds'], records)
+    state['outputs_ready'] = True
+
+
+def show_page(state: dict[str, any], page: int) -> None:
+    state['page'] = page % len(state['pages'])
+    state['next_page'] = time.time() + state['page_interval']
+    write_page(state, logging.DEBUG)
+
+
+def write_page(state: dict[str, any], level: int = logging.INFO) -> None:
+    # a page is only written if it differs from what is shown right now
+    s2olib.shared.write_text_file(state['obs_text_file'], state['pages'][state['page']], level)
+
+
+def get_fields(event: dict[str, any]) -> dict[str, str]:
+    return {
+        'id': event['id'],
+        'date': event['geometry'][0]['date'].split('T')[0] if not event['closed'] else event['closed'].split('T')[0],
+        'status': 'open' if not event['closed'] else 'closed',
+        'categories': ', '.join([v['title'] for v in event['categories']]),
+        'title': event['title'],
+    }
+
+
+def get_points(event: dict[str, any]) -> list[list[float]]:
+    points: list[list[float]] = []
+
+    # points are [lon, lat], polygons are lists of rings of points
+    for geometry in event['geometry']:
+        if geometry['type'] == 'Point':
+            points.append(geometry['coordinates'][:2])
+        else:
+            points += [v[:2] for ring in geometry['coordinates'] for v in ring]
+
+    return points
+
+
+def make_record(template: collections.abc.Callable[[dict[str, any]], str], event: dict[str, any]) -> dict[str, any]:
+    # everything the feeds need is kept, so they can be filtered and rendered without the original event
+    dates: list[str] = [v['date'] for v in event['geometry']] + ([event['closed']] if event['closed'] else [])
+    fields: dict[str, str] = get_fields(event)
+
+    return {
+        'sort': max(dates) if dates else '',
+        'line': template(fields),
+        'fields': fields,
+        'categories': [v['id'] for v in event['categories']],
+        'points': get_points(event),
+    }
+
+
+def load_index(args: argparse.Namespace, index_file: pathlib.Path) -> dict[str, any]:
+    index: dict[str, any] = s2olib.shared.read_json_file(index_file, {})
+
+    # start over if the index was built for other settings or an older format, the full list is fetched once to seed it
+    settings: dict[str, any] = {'status': args.eonet_status, 'limit': args.eonet_limit, 'template': args.eonet_text_template, 'format': 2}
+    if index.get('settings') != settings:
+        index = {'settings': settings, 'watermark': None, 'events': {}}
+
+    return index
+
+
+def merge_index(args: argparse.Namespace, template: collections.abc.Callable[[dict[str, any]], str], index: dict[str, any], events: list[dict[str, any]]) -> None:
+    # only the events in the response get their line rendered again, all others are kept as they are
+    for event in events:
+        status: str = 'open' if not event['closed'] else 'closed'
+
+        if args.eonet_status != 'all' and status != args.eonet_status:
+            index['events'].pop(event['id'], None)
+            continue
+
+        index['events'][event['id']] = make_record(template, event)
+
+    # newest first, limited like the full list would be
+    index['events'] = dict(sorted(index['events'].items(), key=lambda v: v[1]['sort'], reverse=True)[:args.eonet_limit])
+
+
+def parse_feeds(args: argparse.Namespace, values: list[str]) -> list[dict[str, any]]:
+    feeds: list[dict[str, any]] = []
+
+    for v in values:
+        name, _, rest = v.partition(':')
+
+        if not s2olib.shared.OUTPUT_NAME_PATTERN.match(name) or name in [f['name'] for f in feeds]:
+            raise ValueError(f'invalid eonet feed: {v}')
+
+        feed: dict[str, any] = {
+            'name': name,
+            'text_file': args.cache_dir / f'eonet_last_{name}_text',
+            'box': None,
+            'near': None,
+            'categories': None,
+            'template': None,
+        }
+
+        while rest:
+            key, _, value = rest.partition('=')
+
+            # the template goes last, it may contain colons itself
+            if key == 'tpl':
+                feed['template'] = s2olib.shared.compile_template(value, TEXT_VARS)
+                break
+
+            value, _, rest = value.partition(':')
+
+            try:
+                if key == 'bbox' and not feed['box']:
+                    west, south, east, north = [float(n) for n in value.split(',')]
+                    feed['box'] = (west, south, east, north)
+                    valid: bool = -180 <= west <= 180 and -180 <= east <= 180 and -90 <= south <= north <= 90
+                elif key == 'near' and not feed['near']:
+                    lat, lon, km = [float(n) for n in value.split(',')]
+                    feed['near'] = (lat, lon, km)
+                    valid = -90 <= lat <= 90 and -180 <= lon <= 180 and km > 0
+                elif key == 'cat' and not feed['categories']:
+                    feed['categories'] = set(value.split(','))
+                    valid = '' not in feed['categories']
+                else:
+                    valid = False
+            except ValueError:
+                valid = False
+
+            if not valid:
+                raise ValueError(f'invalid eonet feed: {v}')
+
+        feeds.append(feed)
+
+    return feeds
+
+
+def update_feeds(args: argparse.Namespace, feeds: list[dict[str, any]], records: dict[str, dict[str, any]]) -> None:
+    if not feeds:
+        return
+
+    # the indexes are built once per update and shared by all feeds
+    grid: dict[tuple[int, int], set[str]] = {}
+    categories: dict[str, set[str]] = {}
+    order: dict[str, int] = {k: n for n, k in enumerate(records)}
+
+    for k, record in records.items():
+        for lon, lat in record['points']:
+            grid.setdefault(get_cell(lon, lat), set()).add(k)
+
+        for category in record['categories']:
+            categories.setdefault(category, set()).add(k)
+
+    for feed in feeds:
+        found: set[str] = set(records)
+
+        if feed['categories']:
+            found &= set().union(*[categories.get(v, set()) for v in feed['categories']])
+
+        if feed['box']:
+            west, south, east, north = feed['box']
+            found &= query_grid(grid, records, west, south, east, north, lambda lon, lat: is_in_box(feed['box'], lon, lat))
+
+        if feed['near']:
+            lat, lon, km = feed['near']
+            west, south, east, north = get_near_box(lat, lon, km)
+            found &= query_grid(grid, records, west, south, east, north, lambda plon, plat: get_distance(lat, lon, plat, plon) <= km)
+
+        # feeds without their own template reuse the lines of the text file
+        lines: list[str] = [feed['template'](records[k]['fields']) if feed['template'] else records[k]['line'] for k in sorted(found, key=order.get)]
+        s2olib.shared.write_text_file(feed['text_file'], '\n'.join(lines))
+
+
+def get_cell(lon: float, lat: float) -> tuple[int, int]:
+    return (int((lon + 180) // GRID_CELL_SIZE), int((lat + 90) // GRID_CELL_SIZE))
+
+
+def query_grid(grid: dict[tuple[int, int], set[str]], records: dict[str, dict[str, any]], west: float, south: float, east: float, north: float, match: callable) -> set[str]:
+    # only events in the grid cells covering the box are checked point by point
+    found: set[str] = set()
+    ranges: list[tuple[float, float]] = [(west, east)] if west <= east else [(west, 180), (-180, east)]
+
+    for range_west, range_east in ranges:
+        west_cell, south_cell = get_cell(range_west, south)
+        east_cell, north_cell = get_cell(range_east, north)
+
+        for x in range(west_cell, east_cell + 1):
+            for y in range(south_cell, north_cell + 1):
+                for k in grid.get((x, y), ()):
+                    if k not in found and any(match(lon, lat) for lon, lat in records[k]['points']):
+                        found.add(k)
+
+    return found
+
+
+def is_in_box(box: tuple[float, float, float, float], lon: float, lat: float) -> bool:
+    west, south, east, north = box
+
+    if not south <= lat <= north:
+        return False
+
+    # boxes with west > east cross the antimeridian
+    return west <= lon <= east if west <= east else lon >= west or lon <= east
+
+
+def get_near_box(lat: float, lon: float, km: float) -> tuple[float, float, float, float]:
+    dlat: float = math.degrees(km / EARTH_RADIUS)
+    south, north = max(-90.0, lat - dlat), min(90.0, lat + dlat)
+
+    # close to the poles every longitude may be in range
+    if south == -90 or north == 90 or dlat >= 90:
+        return (-180.0, south, 180.0, north)
+
+    dlon: float = min(180.0, dlat / math.cos(math.radians(max(abs(south), abs(north)))))
+    if dlon >= 180:
+        return (-180.0, south, 180.0, north)
 
-            text_list: list[str] = []
+    west: float = (lon - dlon + 540) % 360 - 180
+    east: float = (lon + dlon + 540) % 360 - 180
 
-            for event in data['events']:
-                text_list.append(args.eonet_text_template.replace('\\n', '\n').format(
-                    id=event['id'],
-                    date=event['geometry'][0]['date'].split('T')[0] if not event['closed'] else event['closed'].split('T')[0],
-                    status='open' if not event['closed'] else 'closed',
-                    categories=', '.join([v['title'] for v in event['categories']]),
-                    title=event['title'],
-                ))
+    return (west, south, east, north)
 
-            s2olib.shared.msg(f'updating {obs_text_file.name}')
-            obs_text_file.write_text('\n'.join(text_list))
 
-        s2olib.shared.endofloop_idle(args.interval)
+def get_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    # haversine, in km
+    a: float = math.sin(math.radians(lat2 - lat1) / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
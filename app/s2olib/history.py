@@ -0,0 +1,78 @@
+import io
+import os
+import pathlib
+import shutil
+
+import s2olib.shared
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def add_frame(history_dir: pathlib.Path, source_file: pathlib.Path, max_frames: int, max_size_mb: int) -> bool:
+    # returns True if the frame was added, False if it is already in the history
+    content_hash: str | None = s2olib.shared.get_content_hash(source_file)
+
+    if not content_hash:
+        return False
+
+    history_dir.mkdir(parents=True, exist_ok=True)
+
+    if any(history_dir.glob(f'*_{content_hash}')):
+        return False
+
+    frame_file: pathlib.Path = history_dir / f'{int(source_file.stat().st_mtime * 1000):015d}_{content_hash}'
+
+    # the cache file is always replaced and never modified, so a hardlink is safe and costs no extra space until then
+    try:
+        os.link(source_file, frame_file)
+    except OSError:
+        shutil.copyfile(source_file, frame_file)
+
+    evict_frames(history_dir, max_frames, max_size_mb)
+
+    return True
+
+
+def evict_frames(history_dir: pathlib.Path, max_frames: int, max_size_mb: int) -> None:
+    frames: list[pathlib.Path] = get_frames(history_dir)
+    sizes: list[int] = [v.stat().st_size for v in frames]
+
+    # oldest first, until both limits are met
+    while frames and (len(frames) > max_frames or sum(sizes) > max_size_mb << 20):
+        frames.pop(0).unlink(missing_ok=True)
+        sizes.pop(0)
+
+
+def get_frames(history_dir: pathlib.Path) -> list[pathlib.Path]:
+    return sorted(v for v in history_dir.glob('*_*') if not v.name.startswith('.'))
+
+
+def export_animation(history_dir: pathlib.Path, target_file: pathlib.Path, num_frames: int, size: int, duration: int, decoded: dict[str, any]) -> None:
+    import PIL.Image # https://python-pillow.org
+
+    frames: list[pathlib.Path] = get_frames(history_dir)[-num_frames:]
+    hashes: list[str] = [v.name.split('_', 1)[1] for v in frames]
+
+    # decoded keeps the ready-to-use frames between exports, so every frame is only decoded once
+    for frame_file, content_hash in zip(frames, hashes):
+        if content_hash not in decoded:
+            with PIL.Image.open(frame_file) as image:
+                image.draft('RGB', (size, size))
+                image = image.convert('RGB')
+                image.thumbnail((size, size), PIL.Image.Resampling.LANCZOS)
+                decoded[content_hash] = image.quantize(colors=256)
+
+    for content_hash in list(decoded):
+        if content_hash not in hashes:
+            del decoded[content_hash]
+
+    if not frames:
+        return
+
+    images: list = [decoded[v] for v in hashes]
+
+    buffer = io.BytesIO()
+    images[0].save(buffer, format='GIF', save_all=True, append_images=images[1:], duration=duration, loop=0)
+
+    s2olib.shared.write_file(target_file, buffer.getvalue())
@@ -0,0 +1,111 @@
+import pathlib
+import struct
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+TAIL_SIZE: int = 64
+
+# start of frame markers, the ones that carry the image size
+JPEG_SOF_MARKERS: list[int] = [0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf]
+# markers without a length field
+JPEG_STANDALONE_MARKERS: list[int] = [0x01, 0xd0, 0xd1, 0xd2, 0xd3, 0xd4, 0xd5, 0xd6, 0xd7, 0xd8]
+
+PNG_SIGNATURE: bytes = b'\x89PNG\r\n\x1a\n'
+PNG_IEND: bytes = b'\x00\x00\x00\x00IEND\xaeB`\x82'
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def read_image_info(file: pathlib.Path) -> dict[str, any] | None:
+    # only the headers and the last bytes are read, returns None if the file is not a complete image
+    try:
+        with file.open('rb') as f:
+            head: bytes = f.read(32)
+            size: int = f.seek(0, 2)
+            f.seek(max(0, size - TAIL_SIZE))
+            # some servers pad their files, nothing but padding may follow the end marker
+            tail: bytes = f.read().rstrip(b'\x00\t\n\r ')
+
+            if head.startswith(b'\xff\xd8\xff'):
+                info = read_jpeg_info(f, size) if tail.endswith(b'\xff\xd9') else None
+            elif head.startswith(PNG_SIGNATURE):
+                info = read_png_info(head) if tail.endswith(PNG_IEND) else None
+            elif head.startswith((b'GIF87a', b'GIF89a')):
+                info = read_gif_info(head) if tail.endswith(b';') else None
+            elif head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+                info = read_webp_info(head) if struct.unpack('<I', head[4:8])[0] + 8 <= size else None
+            else:
+                info = None
+
+    except (OSError, struct.error):
+        return None
+
+    if not info or info['width'] <= 0 or info['height'] <= 0:
+        return None
+
+    return info | {'size': size}
+
+
+def read_jpeg_info(f: any, size: int) -> dict[str, any] | None:
+    pos: int = 2
+
+    # walk from segment header to segment header until the frame header
+    while pos + 4 <= size:
+        f.seek(pos)
+        marker: bytes = f.read(4)
+
+        if marker[0] != 0xff:
+            return None
+
+        if marker[1] == 0xff:
+            pos += 1
+            continue
+
+        if marker[1] in JPEG_STANDALONE_MARKERS:
+            pos += 2
+            continue
+
+        if marker[1] in JPEG_SOF_MARKERS:
+            height, width = struct.unpack('>HH', f.read(5)[1:5])
+            return {'format': 'jpeg', 'width': width, 'height': height}
+
+        # start of scan without a frame header before it
+        if marker[1] == 0xda:
+            return None
+
+        pos += 2 + struct.unpack('>H', marker[2:4])[0]
+
+    return None
+
+
+def read_png_info(head: bytes) -> dict[str, any] | None:
+    if head[12:16] != b'IHDR':
+        return None
+
+    width, height = struct.unpack('>II', head[16:24])
+    return {'format': 'png', 'width': width, 'height': height}
+
+
+def read_gif_info(head: bytes) -> dict[str, any]:
+    width, height = struct.unpack('<HH', head[6:10])
+    return {'format': 'gif', 'width': width, 'height': height}
+
+
+def read_webp_info(head: bytes) -> dict[str, any] | None:
+    chunk: bytes = head[12:16]
+
+    if chunk == b'VP8X':
+        width: int = int.from_bytes(head[24:27], 'little') + 1
+        height: int = int.from_bytes(head[27:30], 'little') + 1
+    elif chunk == b'VP8 ':
+        width, height = [v & 0x3fff for v in struct.unpack('<HH', head[26:30])]
+    elif chunk == b'VP8L':
+        bits: int = int.from_bytes(head[21:25], 'little')
+        width, height = (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+    else:
+        return None
+
+    return {'format': 'webp', 'width': width, 'height': height}
@@ -0,0 +1,105 @@
+import argparse
+import fnmatch
+import logging
+import pathlib
+
+import s2olib.server
+import s2olib.shared
+import s2olib.variants
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+CONTENT_TYPES: list[str] = [
+    'image/jpeg',
+    'image/png',
+    'image/gif',
+    'image/webp',
+    'application/json',
+    'text/plain',
+]
+
+DEFAULT_FILES_CHOICE: list[str] = ['*']
+
+ENTRY_FUNC: str = 'daemon'
+
+ARGS: list[dict[str, any]] = [
+    {
+        'name_or_flags': ['--mirror-upstream'],
+        'metavar': 'URL',
+        'type': str,
+        'default': None,
+        'help': 'Specify the address of another space2obs instance running with --server-port, e.g. http://192.168.1.10:8080. Default: none',
+    },
+    {
+        'name_or_flags': ['--mirror-files'],
+        'metavar': 'FILE',
+        'type': str,
+        'nargs': '+',
+        'default': DEFAULT_FILES_CHOICE,
+        'help': f'Specify which output files to mirror, may contain wildcards, e.g. apod_last_* soho_last_c2_image. Default: {" ".join(DEFAULT_FILES_CHOICE)}',
+    },
+]
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def daemon(args: argparse.Namespace):
+    s2olib.shared.run_tools(args, ['mirror'])
+
+
+def setup(args: argparse.Namespace) -> dict[str, any]:
+    if not args.mirror_upstream:
+        s2olib.shared.msg('mirror needs --mirror-upstream', level=logging.ERROR)
+        exit(1)
+
+    return {
+        'upstream': args.mirror_upstream.rstrip('/'),
+    }
+
+
+def run(args: argparse.Namespace, state: dict[str, any]) -> int:
+    upstream: str = state['upstream']
+
+    s2olib.shared.msg(f'checking {upstream}', level=logging.DEBUG)
+    res: s2olib.shared.RemoteData | None = s2olib.shared.fetch_remote_data(f'{upstream}/', args.request_timeout, ['application/json'], max_size_mb=args.max_download_size)
+
+    if not res:
+        s2olib.shared.msg('invalid response data', level=logging.WARNING)
+        return s2olib.shared.retry_later(args, 'mirror')
+
+    failed: bool = False
+
+    for name, etag in res.json().items():
+        if not is_mirrored(args, name):
+            continue
+
+        cache_file: pathlib.Path = args.cache_dir / name
+
+        # the index already tells what changed, files with a known etag are not requested at all
+        if cache_file.is_file() and s2olib.shared.get_fetch_state(cache_file).get('etag') == etag:
+            continue
+
+        s2olib.shared.msg(f'downloading {name}', level=logging.DEBUG)
+        updated = s2olib.shared.download_remote_file(f'{upstream}/{name}', args.request_timeout, CONTENT_TYPES, cache_file, args.max_download_size)
+
+        if updated is None:
+            failed = True
+        else:
+            s2olib.shared.msg(f'updated {name}' if updated else f'no change for {name}', level=logging.INFO if updated else logging.DEBUG)
+            s2olib.variants.update(args, cache_file)
+
+    if failed:
+        return s2olib.shared.retry_later(args, 'mirror')
+
+    return s2olib.shared.get_interval(args, 'mirror')
+
+
+def is_mirrored(args: argparse.Namespace, name: str) -> bool:
+    # names come from another machine, only plain output file names are accepted
+    if '/' in name or '\\' in name or name.startswith('.') or not fnmatch.fnmatchcase(name, s2olib.server.ASSET_PATTERN):
+        return False
+
+    return any(fnmatch.fnmatchcase(name, v) for v in args.mirror_files)
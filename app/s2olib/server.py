@@ -0,0 +1,242 @@
+import argparse
+import fnmatch
+import http.server
+import json
+import pathlib
+import queue
+import threading
+
+import s2olib.shared
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+DEFAULT_HOST: str = '127.0.0.1'
+DEFAULT_PORT: int = 0
+
+ASSET_PATTERN: str = '*_last_*'
+EVENTS_PATH: str = '/events'
+METRICS_PATH: str = '/metrics'
+EVENTS_KEEPALIVE: int = 15
+
+ARGS: list[dict[str, any]] = [
+    {
+        'name_or_flags': ['--server-port'],
+        'metavar': 'PORT',
+        'type': int,
+        'default': DEFAULT_PORT,
+        'help': 'Serve the output files over HTTP on this port, with change notifications for browser sources. Default: 0 (no server)',
+    },
+    {
+        'name_or_flags': ['--server-host'],
+        'metavar': 'HOST',
+        'type': str,
+        'default': DEFAULT_HOST,
+        'help': f'Set the address the server listens on, use 0.0.0.0 to make it reachable from other machines. Default: {DEFAULT_HOST}',
+    },
+]
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+_assets: dict[str, dict[str, any]] = {}
+_assets_lock: threading.Lock = threading.Lock()
+_listeners: list[queue.Queue] = []
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def start(args: argparse.Namespace) -> http.server.ThreadingHTTPServer | None:
+    if not args.server_port:
+        return None
+
+    for file in sorted(args.cache_dir.glob(ASSET_PATTERN)):
+        load_asset(file)
+
+    s2olib.shared.add_publish_hook(load_asset)
+
+    server = http.server.ThreadingHTTPServer((args.server_host, args.server_port), RequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    s2olib.shared.msg(f'serving {args.cache_dir} at http://{args.server_host}:{args.server_port}/')
+
+    return server
+
+
+def load_asset(file: pathlib.Path) -> None:
+    # called by the tools whenever they publish a file, so requests never have to touch the disk
+    if file.name.startswith('.') or not fnmatch.fnmatchcase(file.name, ASSET_PATTERN) or not file.is_file():
+        return
+
+    data: bytes = file.read_bytes()
+    content_hash = s2olib.shared.new_content_hash()
+    content_hash.update(data)
+    etag: str = f'"{content_hash.hexdigest()}"'
+
+    with _assets_lock:
+        if _assets.get(file.name, {}).get('etag') == etag:
+            return
+
+        _assets[file.name] = {
+            'data': data,
+            'etag': etag,
+            'content_type': get_content_type(file, data),
+        }
+
+        for listener in _listeners:
+            listener.put(file.name)
+
+
+def get_content_type(file: pathlib.Path, data: bytes) -> str:
+    # checked images have their format recorded, everything else is sniffed
+    image_info: dict[str, any] | None = s2olib.shared.get_image_info(file)
+
+    if image_info:
+        return f'image/{image_info["format"]}'
+
+    return guess_content_type(file.name, data)
+
+
+def guess_content_type(name: str, data: bytes) -> str:
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if data.startswith((b'GIF87a', b'GIF89a')):
+        return 'image/gif'
+    if data.startswith(b'RIFF') and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if name.endswith('_data'):
+        return 'application/json'
+
+    return 'text/plain; charset=utf-8'
+
+
+def render_metrics(metrics: dict[str, any]) -> str:
+    # prometheus text format
+    lines: list[str] = []
+
+    def add(name: str, type: str, samples: list[tuple[dict[str, str], float]]) -> None:
+        lines.append(f'# TYPE space2obs_{name} {type}')
+        for labels, value in samples:
+            label_text: str = ','.join(f'{k}="{v}"' for k, v in labels.items())
+            lines.append(f'space2obs_{name}{{{label_text}}} {value}' if label_text else f'space2obs_{name} {value}')
+
+    hosts: dict[str, dict[str, any]] = metrics.get('hosts', {})
+    tools: dict[str, dict[str, any]] = metrics.get('tools', {})
+    rate_limit: dict[str, dict[str, int]] = metrics.get('rate_limit', {})
+    store: dict[str, int] = metrics.get('store', {})
+
+    add('requests_total', 'counter', [({'host': h, 'status': s}, n) for h, v in hosts.items() for s, n in v.get('status', {}).items()])
+
+    lines.append('# TYPE space2obs_request_duration_seconds histogram')
+    for h, v in hosts.items():
+        latency: dict[str, any] | None = v.get('latency')
+        if not latency:
+            continue
+        for le, n in zip(s2olib.shared.LATENCY_BUCKETS, latency['buckets']):
+            lines.append(f'space2obs_request_duration_seconds_bucket{{host="{h}",le="{le}"}} {n}')
+        lines.append(f'space2obs_request_duration_seconds_bucket{{host="{h}",le="+Inf"}} {latency["count"]}')
+        lines.append(f'space2obs_request_duration_seconds_sum{{host="{h}"}} {latency["sum"]}')
+        lines.append(f'space2obs_request_duration_seconds_count{{host="{h}"}} {latency["count"]}')
+
+    add('downloaded_bytes_total', 'counter', [({'host': h}, v.get('bytes_downloaded', 0)) for h, v in hosts.items()])
+    add('skipped_bytes_total', 'counter', [({'host': h}, v.get('bytes_skipped', 0)) for h, v in hosts.items()])
+    add('unchanged_responses_total', 'counter', [({'host': h}, v.get('unchanged', 0)) for h, v in hosts.items()])
+    add('rejected_images_total', 'counter', [({'host': h}, v.get('rejected', 0)) for h, v in hosts.items()])
+    add('cache_hit_ratio', 'gauge', [({'host': h}, v['cache_hit_ratio']) for h, v in hosts.items() if 'cache_hit_ratio' in v])
+    add('writes_total', 'counter', [({'file': f}, n) for f, n in metrics.get('writes', {}).items()])
+    add('rate_limit_remaining', 'gauge', [({'name': k}, v['remaining']) for k, v in rate_limit.items()])
+    add('rate_limit_limit', 'gauge', [({'name': k}, v['limit']) for k, v in rate_limit.items()])
+    add('tool_cycles_total', 'counter', [({'tool': t}, v.get('cycles', 0)) for t, v in tools.items()])
+    add('tool_failures_total', 'counter', [({'tool': t}, v.get('failures', 0)) for t, v in tools.items()])
+    add('tool_work_seconds_total', 'counter', [({'tool': t}, v.get('work_seconds', 0)) for t, v in tools.items()])
+    add('store_bytes', 'gauge', [({}, store['bytes'])] if 'bytes' in store else [])
+    add('store_blobs', 'gauge', [({}, store['blobs'])] if 'blobs' in store else [])
+    add('store_deduplicated_total', 'counter', [({}, store.get('deduplicated', 0))])
+    add('store_evictions_total', 'counter', [({}, store.get('evicted', 0))])
+    add('idle_seconds_total', 'counter', [({}, metrics.get('idle_seconds', 0))])
+    add('uptime_seconds', 'gauge', [({}, metrics['uptime_seconds'])])
+
+    return '\n'.join(lines) + '\n'
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self) -> None:
+        path: str = self.path.split('?')[0]
+
+        if path == '/':
+            with _assets_lock:
+                index: dict[str, str] = {k: v['etag'] for k, v in _assets.items()}
+            self.send_data(json.dumps(index).encode(), 'application/json')
+        elif path == EVENTS_PATH:
+            self.send_events()
+        elif path == METRICS_PATH:
+            self.send_data(render_metrics(s2olib.shared.get_metrics()).encode(), 'text/plain; version=0.0.4; charset=utf-8')
+        else:
+            with _assets_lock:
+                asset: dict[str, any] | None = _assets.get(path.lstrip('/'))
+
+            if not asset:
+                self.send_error(404)
+            elif asset['etag'] in self.headers.get('if-none-match', ''):
+                self.send_response(304)
+                self.send_header('ETag', asset['etag'])
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            else:
+                self.send_data(asset['data'], asset['content_type'], asset['etag'])
+
+    def do_HEAD(self) -> None:
+        self.do_GET()
+
+    def send_data(self, data: bytes, content_type: str, etag: str | None = None) -> None:
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        if etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def send_events(self) -> None:
+        # server-sent events: one "changed" event with the file name per update
+        listener: queue.Queue = queue.Queue()
+
+        with _assets_lock:
+            _listeners.append(listener)
+
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.close_connection = True
+
+            while self.command != 'HEAD':
+                try:
+                    self.wfile.write(f'event: changed\ndata: {listener.get(timeout=EVENTS_KEEPALIVE)}\n\n'.encode())
+                except queue.Empty:
+                    self.wfile.write(b': keepalive\n\n')
+                self.wfile.flush()
+
+        except OSError:
+            pass
+
+        finally:
+            with _assets_lock:
+                _listeners.remove(listener)
+
+    def log_message(self, format: str, *args: any) -> None:
+        pass
@@ -1,12 +1,30 @@
+from __future__ import annotations
+
 import argparse
+import collections.abc
+import contextlib
+import dataclasses
 import datetime
+import hashlib
+import heapq
 import importlib
 import itertools
 import json
+import logging
+import logging.handlers
 import os
 import pathlib
+import re
+import signal
+import statistics
+import string
 import sys
+import threading
 import time
+import urllib.parse
+
+if os.name == 'posix':
+    import fcntl
 
 if os.name == 'nt':
     import msvcrt
@@ -18,7 +36,9 @@ if os.name == 'nt':
             ('visible', ctypes.c_byte),
         ]
 
-import requests # https://github.com/psf/requests
+import s2olib.imageinfo
+
+# requests is only imported once a session is set up, see setup_session()
 
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -29,6 +49,13 @@ ENABLED_TOOLS: list[str] = [
     'dnmap',
     'eonet',
     'soho',
+    'mirror',
+]
+
+ENABLED_EXTRAS: list[str] = [
+    'variants',
+    'server',
+    'store',
 ]
 
 DEFAULT_CACHE_DIR: pathlib.Path = pathlib.Path(__file__).parents[1].resolve() / 'cache'
@@ -36,6 +63,30 @@ DEFAULT_SECRETS_FILE: pathlib.Path = pathlib.Path(__file__).parents[1].resolve()
 DEFAULT_INTERVAL: int = 300
 DEFAULT_RETRY_DELAY: int = 60
 DEFAULT_REQUEST_TIMEOUT: int = 10
+DEFAULT_POOL_SIZE: int = 10
+DEFAULT_MAX_RETRIES: int = 2
+DEFAULT_RETRY_BACKOFF: float = 1.0
+DEFAULT_MAX_DOWNLOAD_SIZE: int = 50
+DEFAULT_RATE_LIMIT: int = 1000
+DEFAULT_MIN_INTERVAL: int = 60
+DEFAULT_MAX_INTERVAL: int = 3600
+
+ADAPTIVE_HISTORY_LENGTH: int = 10
+
+LOG_BUFFER_SIZE: int = 100
+
+RETRY_STATUS_CODES: list[int] = [429, 500, 502, 503, 504]
+
+FETCH_STATE_FILE_NAME: str = 'fetch_state'
+RATE_LIMIT_STATE_FILE_NAME: str = 'rate_limit_state'
+STATE_FILE_NAME: str = 'state'
+STATE_VERSION: int = 1
+RATE_LIMIT_PERIOD: int = 3600
+DOWNLOAD_CHUNK_SIZE: int = 64 * 1024
+METRICS_FILE_NAME: str = 'metrics'
+LATENCY_BUCKETS: list[float] = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+LOG_LEVEL_CHOICES: list[str] = ['debug', 'info', 'warning', 'error']
+OUTPUT_NAME_PATTERN: re.Pattern = re.compile('^[a-z0-9-]+$')
 
 ARGPARSER_SETUP: dict[str, any] = {
     'description': 'For more help and examples see README.md or https://github.com/etrusci-org/space2obs',
@@ -52,8 +103,9 @@ ARG_TOOL: dict[str, any] = {
     'name_or_flags': ['tool'],
     'metavar': 'TOOL',
     'type': str,
-    'choices': ENABLED_TOOLS,
-    'help': f'Specify the tool to execute. Choices: {", ".join(ENABLED_TOOLS)}',
+    'nargs': '+',
+    'choices': ENABLED_TOOLS + ['all'],
+    'help': f'Specify one or more tools to execute in this process. Choices: {", ".join(ENABLED_TOOLS + ["all"])}',
 }
 ARG_CACHE_DIR: dict[str, any] = {
     'name_or_flags': ['-c', '--cache-dir'],
@@ -90,6 +142,98 @@ ARG_REQUEST_TIMEOUT: dict[str, any] = {
     'default': DEFAULT_REQUEST_TIMEOUT,
     'help': f'Set the maximum time in seconds for a remote request to complete. Default: {DEFAULT_REQUEST_TIMEOUT}',
 }
+ARG_POOL_SIZE: dict[str, any] = {
+    'name_or_flags': ['--pool-size'],
+    'metavar': 'NUM',
+    'type': int,
+    'default': DEFAULT_POOL_SIZE,
+    'help': f'Set the maximum number of keep-alive connections kept open per host. Default: {DEFAULT_POOL_SIZE}',
+}
+ARG_MAX_RETRIES: dict[str, any] = {
+    'name_or_flags': ['--max-retries'],
+    'metavar': 'NUM',
+    'type': int,
+    'default': DEFAULT_MAX_RETRIES,
+    'help': f'Set how many times a failed remote request is retried right away, with increasing backoff, before giving up. Default: {DEFAULT_MAX_RETRIES}',
+}
+ARG_ADAPTIVE_INTERVAL: dict[str, any] = {
+    'name_or_flags': ['--adaptive-interval'],
+    'action': 'store_true',
+    'default': False,
+    'help': 'Learn how often each source changes and poll around its expected next update, backing off while nothing changes. Default: use the fixed --interval',
+}
+ARG_MIN_INTERVAL: dict[str, any] = {
+    'name_or_flags': ['--min-interval'],
+    'metavar': 'SEC',
+    'type': int,
+    'default': DEFAULT_MIN_INTERVAL,
+    'help': f'Set the shortest interval in seconds used with --adaptive-interval. Default: {DEFAULT_MIN_INTERVAL}',
+}
+ARG_MAX_INTERVAL: dict[str, any] = {
+    'name_or_flags': ['--max-interval'],
+    'metavar': 'SEC',
+    'type': int,
+    'default': DEFAULT_MAX_INTERVAL,
+    'help': f'Set the longest interval in seconds used with --adaptive-interval. Default: {DEFAULT_MAX_INTERVAL}',
+}
+ARG_TOOL_INTERVAL: dict[str, any] = {
+    'name_or_flags': ['--tool-interval'],
+    'metavar': 'TOOL:SEC',
+    'type': str,
+    'nargs': '+',
+    'default': [],
+    'help': 'Override --interval for specific tools, e.g. apod:3600 soho:600. Default: use --interval for all tools',
+}
+ARG_TOOL_RETRY_DELAY: dict[str, any] = {
+    'name_or_flags': ['--tool-retry-delay'],
+    'metavar': 'TOOL:SEC',
+    'type': str,
+    'nargs': '+',
+    'default': [],
+    'help': 'Override --retry-delay for specific tools, e.g. apod:120. Default: use --retry-delay for all tools',
+}
+ARG_MAX_DOWNLOAD_SIZE: dict[str, any] = {
+    'name_or_flags': ['--max-download-size'],
+    'metavar': 'MB',
+    'type': int,
+    'default': DEFAULT_MAX_DOWNLOAD_SIZE,
+    'help': f'Set the maximum size in megabytes of a single download, larger responses are discarded. Default: {DEFAULT_MAX_DOWNLOAD_SIZE}',
+}
+ARG_RATE_LIMIT: dict[str, any] = {
+    'name_or_flags': ['--rate-limit'],
+    'metavar': 'NUM',
+    'type': int,
+    'default': DEFAULT_RATE_LIMIT,
+    'help': f'Set the number of NASA API requests per hour shared by all tools and processes using this cache directory, corrected by the limits the API reports. Default: {DEFAULT_RATE_LIMIT}',
+}
+
+ARG_ONCE: dict[str, any] = {
+    'name_or_flags': ['--once'],
+    'action': 'store_true',
+    'default': False,
+    'help': 'Run every selected tool one time and exit. The exit status is 0 if all of them succeeded, 1 otherwise. Default: keep running',
+}
+ARG_HEADLESS: dict[str, any] = {
+    'name_or_flags': ['--headless'],
+    'action': 'store_true',
+    'default': False,
+    'help': 'Wait silently between runs and write plain log lines in batches before each wait, e.g. when running as a service. Used automatically if the output is not a terminal. Default: animate the terminal while waiting',
+}
+ARG_LOG_LEVEL: dict[str, any] = {
+    'name_or_flags': ['--log-level'],
+    'metavar': 'LEVEL',
+    'type': str,
+    'choices': LOG_LEVEL_CHOICES,
+    'default': None,
+    'help': f'Set the least important messages to show. Choices: {", ".join(LOG_LEVEL_CHOICES)}. Default: debug, or info when headless',
+}
+ARG_METRICS_INTERVAL: dict[str, any] = {
+    'name_or_flags': ['--metrics-interval'],
+    'metavar': 'SEC',
+    'type': int,
+    'default': 0,
+    'help': f'Write request, download, write and timing metrics as JSON to the {METRICS_FILE_NAME} file in the cache directory every SEC seconds. Default: 0 (no metrics file)',
+}
 
 ARGS: list[dict[str, any]] = [
     ARG_HELP,
@@ -97,7 +241,20 @@ ARGS: list[dict[str, any]] = [
     ARG_SECRETS_FILE,
     ARG_INTERVAL,
     ARG_RETRY_DELAY,
+    ARG_TOOL_INTERVAL,
+    ARG_TOOL_RETRY_DELAY,
+    ARG_ADAPTIVE_INTERVAL,
+    ARG_MIN_INTERVAL,
+    ARG_MAX_INTERVAL,
     ARG_REQUEST_TIMEOUT,
+    ARG_POOL_SIZE,
+    ARG_MAX_RETRIES,
+    ARG_MAX_DOWNLOAD_SIZE,
+    ARG_RATE_LIMIT,
+    ARG_ONCE,
+    ARG_HEADLESS,
+    ARG_LOG_LEVEL,
+    ARG_METRICS_INTERVAL,
 ]
 
 SPINNER_FRAMES: dict[str, dict[str, float | list[str]]] = {
@@ -125,18 +282,36 @@ SPINNER_FRAMES: dict[str, dict[str, float | list[str]]] = {
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 
-ARG_GROUPS: list[tuple[str, list[dict[str, any]]]] = [
-    ('shared options', ARGS),
-]
-
-for d in ENABLED_TOOLS:
-    m = importlib.import_module(f's2olib.{d}')
-    ARG_GROUPS.append((f'{d} options', getattr(m, 'ARGS')))
+_session: requests.Session | None = None
+_publish_hooks: list[collections.abc.Callable[[pathlib.Path], None]] = []
+_metrics: dict[str, any] = {'started': time.time()}
+_metrics_lock: threading.Lock = threading.Lock()
+_headless: bool = False
+_log_level: int = logging.DEBUG
+_logger: logging.Logger = logging.getLogger('space2obs')
+_wake: threading.Event = threading.Event()
+_stop: threading.Event = threading.Event()
+_poll: threading.Event = threading.Event()
 
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 
+def get_arg_groups(argv: list[str]) -> list[tuple[str, list[dict[str, any]]]]:
+    # only the modules of the tools named on the command line are imported, except for the help
+    if not argv or '-h' in argv or '--help' in argv:
+        tools: list[str] = ENABLED_TOOLS
+    else:
+        tools = get_tools([v for v in argv if v in ENABLED_TOOLS + ['all']])
+
+    groups: list[tuple[str, list[dict[str, any]]]] = [('shared options', ARGS)]
+
+    for d in tools + ENABLED_EXTRAS:
+        groups.append((f'{d} options', importlib.import_module(f's2olib.{d}').ARGS))
+
+    return groups
+
+
 def add_args(dest: argparse.ArgumentParser | argparse._ArgumentGroup, args: list[dict[str, any]]) -> None:
     for arg in args:
         name_or_flags: list = arg['name_or_flags']
@@ -155,11 +330,43 @@ def get_secrets(file: pathlib.Path, keys: list[str]) -> dict[str, str]:
         return secrets
 
     except json.decoder.JSONDecodeError as e:
-        msg(f'failed to parse secrets file: {e}')
+        msg(f'failed to parse secrets file: {e}', level=logging.ERROR)
         exit(1)
 
 
-def msg(msg: str = '', start: str = '', end: str = '\n', plain: bool = False) -> None:
+def setup_output(args: argparse.Namespace) -> None:
+    global _headless, _log_level
+
+    _headless = args.headless or not sys.stdout.isatty()
+    _log_level = getattr(logging, (args.log_level or ('info' if _headless else 'debug')).upper())
+
+    if _headless:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter('%(asctime)s | %(levelname)s | %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+        # lines are written in batches, a warning or worse goes out right away with the lines before it,
+        # the rest before idling and at exit
+        logging.basicConfig(handlers=[logging.handlers.MemoryHandler(LOG_BUFFER_SIZE, flushLevel=logging.WARNING, target=handler)])
+        _logger.setLevel(_log_level)
+
+
+def flush_log() -> None:
+    for handler in logging.getLogger().handlers:
+        handler.flush()
+
+
+def is_headless() -> bool:
+    return _headless
+
+
+def msg(msg: str = '', start: str = '', end: str = '\n', plain: bool = False, level: int = logging.INFO) -> None:
+    if level < _log_level:
+        return
+
+    if _headless:
+        if msg:
+            _logger.log(level, msg)
+        return
+
     if msg:
         if not plain:
             sys.stdout.write(f'{start}{datetime.datetime.now().strftime("%H:%M:%S")} | {msg}{end}')
@@ -171,42 +378,526 @@ def msg(msg: str = '', start: str = '', end: str = '\n', plain: bool = False) ->
     sys.stdout.flush()
 
 
-def endofloop_idle(interval: int) -> None:
-    msg(f'next run at {next_datetime(interval)}', end=' ')
-    spinner(interval, end='\n\n')
+def endofloop_idle(interval: float, label: str = 'next run') -> None:
+    # returns early if woken up by a signal
+    if _headless:
+        msg(f'{label} at {next_datetime(interval)}', level=logging.DEBUG)
+        flush_log()
+        _wake.wait(interval)
+    else:
+        msg(f'{label} at {next_datetime(interval)}', end=' ', level=logging.DEBUG)
+        spinner(interval, end='\n\n' if _log_level <= logging.DEBUG else '')
+
+
+def handle_signal(signum: int, frame: any) -> None:
+    # only sets flags, the scheduler acts on them once it is awake
+    if signum == signal.SIGTERM:
+        _stop.set()
+    else:
+        _poll.set()
+
+    _wake.set()
+
+
+def setup_signals() -> None:
+    # SIGTERM stops after the current run, SIGUSR1 (not on windows) makes all tools run right away
+    if threading.current_thread() is not threading.main_thread():
+        return
+
+    signal.signal(signal.SIGTERM, handle_signal)
+
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, handle_signal)
+
+
+def get_tools(choice: list[str]) -> list[str]:
+    # mirror fetches from another instance instead of the sources, so 'all' leaves it out
+    return [v for v in ENABLED_TOOLS if v in choice or ('all' in choice and v != 'mirror')]
+
+
+def parse_tool_seconds(values: list[str]) -> dict[str, int]:
+    parsed: dict[str, int] = {}
+
+    for v in values:
+        tool, _, sec = v.partition(':')
+        if tool not in ENABLED_TOOLS or not sec.isdigit():
+            raise ValueError(f'invalid TOOL:SEC value: {v}')
+        parsed[tool] = int(sec)
 
+    return parsed
 
-def retry_idle(retry_delay: int) -> None:
-    msg(f'retry at {next_datetime(retry_delay)}', end=' ')
-    spinner(retry_delay, 'spinleft', end='\n\n')
+
+def get_interval(args: argparse.Namespace, tool: str) -> int:
+    return args.tool_interval.get(tool, args.interval)
+
+
+def get_retry_delay(args: argparse.Namespace, tool: str) -> int:
+    return args.tool_retry_delay.get(tool, args.retry_delay)
+
+
+def get_resume_time(args: argparse.Namespace, tool: str, next_due: float) -> float:
+    # a saved due time is never later than the current settings allow, e.g. after lowering --interval
+    longest: float = args.max_interval if args.adaptive_interval else get_interval(args, tool)
+    return min(next_due, time.time() + longest)
+
+
+def retry_later(args: argparse.Namespace, tool: str) -> int:
+    # for tools to return after a failed run, so the failure is counted
+    add_metric(['tools', tool, 'failures'])
+    return get_retry_delay(args, tool)
+
+
+def get_next_delay(args: argparse.Namespace, tool: str, cache_file: pathlib.Path, changed: bool) -> float:
+    if not args.adaptive_interval:
+        return get_interval(args, tool)
+
+    now: float = time.time()
+    state: dict[str, any] = get_fetch_state(cache_file)
+    changes: list[float] = state.get('changes', [])
+    misses: int = state.get('misses', 0)
+
+    if changed:
+        changes = (changes + [now])[-ADAPTIVE_HISTORY_LENGTH:]
+        misses = 0
+    else:
+        misses += 1
+
+    update_fetch_state(cache_file, {'changes': changes, 'misses': misses})
+
+    # back off exponentially for every poll that did not see a change
+    delay: float = args.min_interval * 2 ** min(misses, 32)
+
+    # if the source updates regularly, wait until just after its next expected update instead
+    if len(changes) >= 2:
+        cadence: float = statistics.median([b - a for a, b in zip(changes, changes[1:])])
+        expected: float = changes[-1] + cadence
+        if expected > now:
+            delay = expected - now + min(args.min_interval, cadence * 0.1)
+
+    return max(args.min_interval, min(args.max_interval, delay))
+
+
+def run_tools(args: argparse.Namespace, tools: list[str]) -> None:
+    # every tool is a job that runs one cycle and tells when it wants to run again,
+    # the heap always has the job that is due next on top
+    modules: dict[str, any] = {}
+    states: dict[str, dict[str, any]] = {}
+    jobs: list[tuple[float, int, str]] = []
+    saved: dict[str, dict[str, any]] = load_snapshot(args.cache_dir)
+
+    for order, tool in enumerate(tools):
+        modules[tool] = importlib.import_module(f's2olib.{tool}')
+        states[tool] = modules[tool].setup(args)
+
+        # --once always does a real run of every tool, whatever the schedule says
+        if tool in saved and hasattr(modules[tool], 'restore') and not args.once:
+            modules[tool].restore(args, states[tool], saved[tool])
+
+        # pick up the schedule of the previous process
+        heapq.heappush(jobs, (get_resume_time(args, tool, saved.get(tool, {}).get('next_due', 0.0)), order, tool))
+
+    if args.once:
+        failed: list[str] = [tool for tool in tools if not run_tool(args, tool, modules[tool], states[tool], len(tools) > 1)[1]]
+        if args.metrics_interval:
+            write_json_file(args.cache_dir / METRICS_FILE_NAME, get_metrics())
+        if failed:
+            msg(f'failed: {", ".join(failed)}', level=logging.ERROR)
+        exit(1 if failed else 0)
+
+    setup_signals()
+
+    while True:
+        _wake.clear()
+
+        if _stop.is_set():
+            msg('stopped')
+            return
+
+        if _poll.is_set():
+            _poll.clear()
+            msg('polling now')
+            jobs = [(0.0, order, tool) for _, order, tool in jobs]
+            heapq.heapify(jobs)
+            for tool in tools:
+                if hasattr(modules[tool], 'poll_now'):
+                    modules[tool].poll_now(args, states[tool])
+
+        due, order, tool = jobs[0]
+
+        wait: float = due - time.time()
+        if wait > 0:
+            started: float = time.perf_counter()
+            endofloop_idle(wait, f'next {tool} run' if len(tools) > 1 else 'next run')
+            add_metric(['idle_seconds'], time.perf_counter() - started)
+            # woken up early, so look at the flags again first
+            if _wake.is_set():
+                continue
+
+        heapq.heappop(jobs)
+        delay, _ = run_tool(args, tool, modules[tool], states[tool], len(tools) > 1)
+
+        heapq.heappush(jobs, (time.time() + delay, order, tool))
+
+
+def run_tool(args: argparse.Namespace, tool: str, module: any, state: dict[str, any], show_name: bool) -> tuple[float, bool]:
+    # returns the delay until the next run and whether this run succeeded
+    if show_name:
+        msg(f'[{tool}]', level=logging.DEBUG)
+
+    failures: int = get_metric(['tools', tool, 'failures'])
+    started: float = time.perf_counter()
+
+    try:
+        delay: float = module.run(args, state)
+    except Exception as e:
+        msg(f'{tool} failed: {e}', level=logging.WARNING)
+        delay = retry_later(args, tool)
+
+    add_metric(['tools', tool, 'cycles'])
+    add_metric(['tools', tool, 'work_seconds'], time.perf_counter() - started)
+
+    succeeded: bool = get_metric(['tools', tool, 'failures']) == failures
+    now: float = time.time()
+
+    with snapshot_state(args.cache_dir) as snapshot:
+        entry: dict[str, any] = snapshot['tools'].setdefault(tool, {})
+        entry.update({'last_run': now, 'next_due': now + delay})
+        if succeeded:
+            entry['last_success'] = now
+        if hasattr(module, 'snapshot'):
+            entry.update(module.snapshot(args, state))
+
+    return delay, succeeded
 
 
 def next_datetime(in_sec: int = 0, format: str = '%H:%M:%S') -> str:
     return datetime.datetime.fromtimestamp(time.time() + in_sec).strftime(format)
 
 
-def fetch_remote_data(url: str, timeout: int, content_types: list[str]) -> requests.Response | None:
+@dataclasses.dataclass
+class RemoteData:
+    # the body is read while it is hashed, so it is kept here instead of on the response,
+    # both are None for a 304
+    url: str
+    res: requests.Response
+    content: bytes | None = None
+    content_hash: str | None = None
+
+    def json(self) -> any:
+        return json.loads(self.content)
+
+
+def fetch_remote_data(url: str, timeout: int, content_types: list[str], cache_file: pathlib.Path | None = None, max_size_mb: int = DEFAULT_MAX_DOWNLOAD_SIZE) -> RemoteData | None:
     try:
-        res = requests.get(url, timeout=timeout)
-        res.raise_for_status()
+        res = open_remote_data(url, timeout, content_types, cache_file, max_size_mb)
+
+        if not res:
+            return None
 
-        res_content_type: list[str] = res.headers['content-type'].lower().split(';')
-        # print(res.headers)
-        # print(res_content_type)
+        if not_modified(res):
+            return RemoteData(url, res)
+
+        # hash the body while it comes in instead of going over it again afterwards
+        content_hash = new_content_hash()
+        chunks: list[bytes] = []
+        for chunk in iter_remote_data(res, max_size_mb):
+            content_hash.update(chunk)
+            chunks.append(chunk)
+        data: RemoteData = RemoteData(url, res, b''.join(chunks), content_hash.hexdigest())
+
+        msg(f'retrieved {bytes_for_humans(len(data.content))}', level=logging.DEBUG)
+
+        # the validators are saved by the caller, once the cache file holds this content
+        return data
+
+    except Exception as e:
+        msg(f'request error: {e}', level=logging.WARNING)
+
+
+def download_remote_file(url: str, timeout: int, content_types: list[str], cache_file: pathlib.Path, max_size_mb: int = DEFAULT_MAX_DOWNLOAD_SIZE) -> bool | None:
+    # returns True if cache_file was updated, False if it is still up to date, None on failure
+    tmp_file: pathlib.Path = get_tmp_file(cache_file)
+
+    try:
+        res = open_remote_data(url, timeout, content_types, cache_file, max_size_mb)
 
         if not res:
             return None
 
-        for v in res_content_type:
-            v = v.strip()
-            if v in content_types:
-                msg(f'retrieved {bytes_for_humans(len(res.content))}')
-                return res
+        if not_modified(res):
+            return False
 
-        return None
+        content_hash = new_content_hash()
+        size: int = 0
+        with tmp_file.open('wb') as f:
+            for chunk in iter_remote_data(res, max_size_mb):
+                content_hash.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+
+        msg(f'retrieved {bytes_for_humans(size)}', level=logging.DEBUG)
+
+        # a truncated download or an error page labelled as image must never replace a good file
+        image_info: dict[str, any] | None = None
+        if res.headers.get('content-type', '').lower().startswith('image/'):
+            image_info = s2olib.imageinfo.read_image_info(tmp_file)
+            if not image_info:
+                msg(f'invalid image data from {url}', level=logging.WARNING)
+                add_metric(['hosts', get_host(url), 'rejected'])
+                return None
+
+        validators: dict[str, str | None] = get_validators(url, res)
+
+        if content_hash.hexdigest() == get_content_hash(cache_file):
+            add_metric(['hosts', get_host(url), 'unchanged'])
+            update_fetch_state(cache_file, validators)
+            return False
+
+        os.replace(tmp_file, cache_file)
+        update_fetch_state(cache_file, validators | {'hash': content_hash.hexdigest(), 'image': image_info})
+        publish(cache_file)
+
+        return True
 
     except Exception as e:
-        msg(f'request error: {e}')
+        msg(f'request error: {e}', level=logging.WARNING)
+
+    finally:
+        tmp_file.unlink(missing_ok=True)
+
+
+def open_remote_data(url: str, timeout: int, content_types: list[str], cache_file: pathlib.Path | None, max_size_mb: int) -> requests.Response | None:
+    headers: dict[str, str] = {}
+
+    # only ask for a conditional response if there is something to fall back to
+    if cache_file and cache_file.is_file():
+        validators: dict[str, str] = get_fetch_state(cache_file)
+        if validators.get('url') != url:
+            validators = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    # only the headers are read here, the body is left to the caller
+    started: float = time.perf_counter()
+    try:
+        res = get_session().get(url, timeout=timeout, headers=headers, stream=True)
+    except Exception:
+        add_metric(['hosts', get_host(url), 'status', 'error'])
+        raise
+    observe_request(url, res.status_code, time.perf_counter() - started)
+
+    # reading the (empty or short) body hands the connection back to the pool
+    if not res.ok:
+        res.content
+        res.raise_for_status()
+
+    if not_modified(res):
+        res.content
+        msg('not modified', level=logging.DEBUG)
+        if cache_file and cache_file.is_file():
+            add_metric(['hosts', get_host(url), 'bytes_skipped'], cache_file.stat().st_size)
+        return res
+
+    res_content_type: list[str] = res.headers.get('content-type', '').lower().split(';')
+    # print(res.headers)
+    # print(res_content_type)
+
+    if not res or not any(v.strip() in content_types for v in res_content_type):
+        msg(f'unexpected content type: {res.headers.get("content-type")}', level=logging.WARNING)
+        res.close()
+        return None
+
+    if int(res.headers.get('content-length', 0)) > max_size_mb << 20:
+        msg(f'response too large: {bytes_for_humans(int(res.headers["content-length"]), "mb")}', level=logging.WARNING)
+        res.close()
+        return None
+
+    return res
+
+
+def iter_remote_data(res: requests.Response, max_size_mb: int) -> collections.abc.Iterator[bytes]:
+    size: int = 0
+    host: str = get_host(res.url)
+
+    for chunk in res.iter_content(DOWNLOAD_CHUNK_SIZE):
+        size += len(chunk)
+        add_metric(['hosts', host, 'bytes_downloaded'], len(chunk))
+        if size > max_size_mb << 20:
+            res.close()
+            raise ValueError(f'response exceeds {max_size_mb} MB')
+        yield chunk
+
+
+def setup_session(pool_size: int = DEFAULT_POOL_SIZE, max_retries: int = DEFAULT_MAX_RETRIES) -> requests.Session:
+    global _session
+
+    import requests # https://github.com/psf/requests
+    import requests.adapters
+    import urllib3.util.retry
+
+    retry = urllib3.util.retry.Retry(
+        total=max_retries,
+        backoff_factor=DEFAULT_RETRY_BACKOFF,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=['GET'],
+        raise_on_status=False,
+    )
+
+    # one pool per host, each keeping up to pool_size connections alive
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    if _session:
+        _session.close()
+
+    _session = session
+
+    return _session
+
+
+def get_session() -> requests.Session:
+    return _session or setup_session()
+
+
+def not_modified(res: requests.Response | None) -> bool:
+    return res is not None and res.status_code == 304
+
+
+def new_content_hash() -> hashlib.blake2b:
+    return hashlib.blake2b(digest_size=16)
+
+
+def get_content_hash(cache_file: pathlib.Path) -> str | None:
+    if not cache_file.is_file():
+        return None
+
+    content_hash: str | None = get_fetch_state(cache_file).get('hash', None)
+
+    # files written before hashes were recorded get hashed once, so they are not rewritten needlessly
+    if not content_hash:
+        h = new_content_hash()
+        with cache_file.open('rb') as f:
+            while chunk := f.read(DOWNLOAD_CHUNK_SIZE):
+                h.update(chunk)
+        content_hash = h.hexdigest()
+        update_fetch_state(cache_file, {'hash': content_hash})
+
+    return content_hash
+
+
+def get_image_info(cache_file: pathlib.Path) -> dict[str, any] | None:
+    # format, width, height and size of a downloaded image, recorded when it was checked
+    return get_fetch_state(cache_file).get('image')
+
+
+def is_unchanged(data: RemoteData, cache_file: pathlib.Path) -> bool:
+    if not_modified(data.res):
+        return True
+
+    if data.content_hash == get_content_hash(cache_file):
+        add_metric(['hosts', get_host(data.res.url), 'unchanged'])
+        # the cache file holds this content already, so it can be asked for conditionally from now on
+        update_fetch_state(cache_file, get_validators(data.url, data.res))
+        return True
+
+    return False
+
+
+def write_cache_file(cache_file: pathlib.Path, data: RemoteData) -> None:
+    # the validators only count once the new content is in place, like in download_remote_file()
+    replace_file(cache_file, data.content)
+    update_fetch_state(cache_file, get_validators(data.url, data.res) | {'hash': data.content_hash})
+    publish(cache_file)
+
+
+def get_validators(url: str, res: requests.Response) -> dict[str, str | None]:
+    # tied to the url they were sent for, another request for the same cache file must not use them
+    return {
+        'url': url,
+        'etag': res.headers.get('etag', None),
+        'last_modified': res.headers.get('last-modified', None),
+    }
+
+
+def write_file(file: pathlib.Path, data: bytes) -> None:
+    replace_file(file, data)
+    publish(file)
+
+
+def replace_file(file: pathlib.Path, data: bytes) -> None:
+    # write next to the target and swap it in, so readers never see a half-written file,
+    # unlike write_file() nobody is told about it
+    tmp_file: pathlib.Path = get_tmp_file(file)
+
+    try:
+        with tmp_file.open('wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, file)
+    finally:
+        tmp_file.unlink(missing_ok=True)
+
+
+def add_publish_hook(hook: collections.abc.Callable[[pathlib.Path], None]) -> None:
+    _publish_hooks.append(hook)
+
+
+def publish(file: pathlib.Path) -> None:
+    # tells everyone interested (e.g. the server) that file has new content
+    add_metric(['writes', file.name])
+
+    for hook in _publish_hooks:
+        hook(file)
+
+
+def get_tmp_file(file: pathlib.Path) -> pathlib.Path:
+    return file.with_name(f'.{file.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+
+
+def get_fetch_state(cache_file: pathlib.Path) -> dict[str, any]:
+    # the file is always swapped in as a whole, so reading it needs no lock
+    return read_json_file(cache_file.parent / FETCH_STATE_FILE_NAME, {}).get(cache_file.name, {})
+
+
+def update_fetch_state(cache_file: pathlib.Path, values: dict[str, any]) -> None:
+    with fetch_state(cache_file.parent) as state:
+        state.setdefault(cache_file.name, {}).update(values)
+
+
+def remove_fetch_state(cache_file: pathlib.Path) -> None:
+    with fetch_state(cache_file.parent) as state:
+        state.pop(cache_file.name, None)
+
+
+@contextlib.contextmanager
+def fetch_state(cache_dir: pathlib.Path) -> collections.abc.Iterator[dict[str, dict[str, any]]]:
+    # shared by all processes using the same cache directory
+    state_file: pathlib.Path = cache_dir / FETCH_STATE_FILE_NAME
+
+    with lock_file(state_file.with_name(f'{state_file.name}.lock')):
+        state: dict[str, dict[str, any]] = read_json_file(state_file, {})
+        yield state
+        write_json_file(state_file, state)
+
+
+def read_json_file(file: pathlib.Path, default: any = None) -> any:
+    try:
+        return json.loads(file.read_text())
+    except (OSError, json.decoder.JSONDecodeError):
+        return default
+
+
+def write_json_file(file: pathlib.Path, data: any) -> None:
+    # only used for the internal state files, which are not output files
+    replace_file(file, json.dumps(data).encode())
 
 
 def bytes_for_humans(bytes: int, unit: str = 'kb', prec: int = 1) -> float:
@@ -219,15 +910,175 @@ def bytes_for_humans(bytes: int, unit: str = 'kb', prec: int = 1) -> float:
     return f'{bytes / float(1<<factor):.{prec}f} {unit.upper()}'
 
 
-def check_xrate(res: requests.Response) -> None:
+def check_xrate(res: requests.Response, cache_dir: pathlib.Path, name: str = 'nasa_api') -> None:
+    # e.g. 304 responses may come without rate limit headers
+    if 'x-ratelimit-remaining' not in res.headers:
+        return
+
     xrate_rem = int(res.headers.get('x-ratelimit-remaining', -1))
     xrate_limit = int(res.headers.get('x-ratelimit-limit', -1))
 
-    msg(f'rate limit usage {xrate_rem}/{xrate_limit}')
+    msg(f'rate limit usage {xrate_rem}/{xrate_limit}', level=logging.DEBUG)
+    set_metric(['rate_limit', name], {'remaining': xrate_rem, 'limit': xrate_limit})
+
+    # the api knows best, so the shared budget is corrected to what it reports
+    with rate_limit_state(cache_dir) as state:
+        bucket: dict[str, float] = state.setdefault(name, {})
+        bucket['tokens'] = max(0, xrate_rem)
+        bucket['updated'] = time.time()
+        if xrate_limit > 0:
+            bucket['capacity'] = xrate_limit
 
     if xrate_rem <= 0:
-        msg(f'rate limit exceeded')
-        exit(10)
+        msg(f'rate limit exceeded, throttling requests', level=logging.WARNING)
+
+
+def acquire_rate_limit(cache_dir: pathlib.Path, capacity: int, name: str = 'nasa_api') -> float:
+    # token bucket shared by all processes, returns 0 if a request may be sent now,
+    # otherwise the seconds to wait until the next token is available
+    with rate_limit_state(cache_dir) as state:
+        now: float = time.time()
+        bucket: dict[str, float] = state.setdefault(name, {})
+        bucket.setdefault('capacity', capacity)
+        rate: float = bucket['capacity'] / RATE_LIMIT_PERIOD
+        tokens: float = min(bucket['capacity'], bucket.get('tokens', bucket['capacity']) + (now - bucket.get('updated', now)) * rate)
+        bucket['updated'] = now
+
+        if tokens >= 1:
+            bucket['tokens'] = tokens - 1
+            return 0.0
+
+        bucket['tokens'] = tokens
+        wait: float = (1 - tokens) / rate
+        msg(f'rate limit budget used up, next request at {next_datetime(wait)}')
+
+        return wait
+
+
+@contextlib.contextmanager
+def rate_limit_state(cache_dir: pathlib.Path) -> collections.abc.Iterator[dict[str, dict[str, float]]]:
+    state_file: pathlib.Path = cache_dir / RATE_LIMIT_STATE_FILE_NAME
+
+    with lock_file(state_file.with_name(f'{state_file.name}.lock')):
+        state: dict[str, dict[str, float]] = read_json_file(state_file, {})
+        yield state
+        write_json_file(state_file, state)
+
+
+def load_snapshot(cache_dir: pathlib.Path) -> dict[str, dict[str, any]]:
+    snapshot: dict[str, any] = read_json_file(cache_dir / STATE_FILE_NAME, {})
+
+    # a snapshot of another version is not trusted, the tools then start fresh
+    if snapshot.get('version') != STATE_VERSION:
+        return {}
+
+    return snapshot.get('tools', {})
+
+
+@contextlib.contextmanager
+def snapshot_state(cache_dir: pathlib.Path) -> collections.abc.Iterator[dict[str, any]]:
+    state_file: pathlib.Path = cache_dir / STATE_FILE_NAME
+
+    with lock_file(state_file.with_name(f'{state_file.name}.lock')):
+        snapshot: dict[str, any] = read_json_file(state_file, {})
+        if snapshot.get('version') != STATE_VERSION:
+            snapshot = {'version': STATE_VERSION, 'tools': {}}
+        yield snapshot
+        write_json_file(state_file, snapshot)
+
+
+@contextlib.contextmanager
+def lock_file(file: pathlib.Path) -> collections.abc.Iterator[None]:
+    # exclusive lock across processes and threads, released when the block is left
+    with file.open('a+b') as f:
+        if os.name == 'nt':
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+        try:
+            yield
+        finally:
+            if os.name == 'nt':
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def get_host(url: str) -> str:
+    return urllib.parse.urlsplit(url).netloc or '?'
+
+
+def add_metric(keys: list[str], value: float = 1) -> None:
+    # keys is the path to the counter in the nested metrics dict, e.g. ['hosts', host, 'bytes_downloaded']
+    with _metrics_lock:
+        entry: dict[str, any] = _metrics
+        for k in keys[:-1]:
+            entry = entry.setdefault(k, {})
+        entry[keys[-1]] = entry.get(keys[-1], 0) + value
+
+
+def set_metric(keys: list[str], value: any) -> None:
+    with _metrics_lock:
+        entry: dict[str, any] = _metrics
+        for k in keys[:-1]:
+            entry = entry.setdefault(k, {})
+        entry[keys[-1]] = value
+
+
+def get_metric(keys: list[str], default: any = 0) -> any:
+    with _metrics_lock:
+        entry: any = _metrics
+        for k in keys:
+            if not isinstance(entry, dict) or k not in entry:
+                return default
+            entry = entry[k]
+        return entry
+
+
+def observe_request(url: str, status: int, seconds: float) -> None:
+    with _metrics_lock:
+        entry: dict[str, any] = _metrics.setdefault('hosts', {}).setdefault(get_host(url), {})
+        entry.setdefault('status', {})
+        entry['status'][str(status)] = entry['status'].get(str(status), 0) + 1
+        entry['requests'] = entry.get('requests', 0) + 1
+
+        # cumulative buckets, like prometheus histograms
+        latency: dict[str, any] = entry.setdefault('latency', {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0})
+        for i, le in enumerate(LATENCY_BUCKETS):
+            if seconds <= le:
+                latency['buckets'][i] += 1
+        latency['sum'] += seconds
+        latency['count'] += 1
+
+
+def get_metrics() -> dict[str, any]:
+    with _metrics_lock:
+        metrics: dict[str, any] = json.loads(json.dumps(_metrics))
+
+    metrics['uptime_seconds'] = time.time() - metrics.pop('started')
+
+    for entry in metrics.get('hosts', {}).values():
+        requests_count: int = entry.get('requests', 0)
+        not_modified_count: int = entry.get('status', {}).get('304', 0)
+        entry['not_modified_ratio'] = not_modified_count / requests_count if requests_count else 0.0
+        entry['cache_hit_ratio'] = (not_modified_count + entry.get('unchanged', 0)) / requests_count if requests_count else 0.0
+
+    return metrics
+
+
+def start_metrics_file(args: argparse.Namespace) -> None:
+    if not args.metrics_interval:
+        return
+
+    def flush() -> None:
+        while True:
+            time.sleep(args.metrics_interval)
+            write_json_file(args.cache_dir / METRICS_FILE_NAME, get_metrics())
+
+    threading.Thread(target=flush, daemon=True).start()
 
 
 def spinner(duration: float, type: str = 'spinright', start: str = '', end: str = '') -> None:
@@ -242,8 +1093,10 @@ def spinner(duration: float, type: str = 'spinright', start: str = '', end: str
         f = next(frames)
         sys.stdout.write(f)
         sys.stdout.flush()
-        time.sleep(SPINNER_FRAMES[type]['i'])
+        woken: bool = _wake.wait(SPINNER_FRAMES[type]['i'])
         sys.stdout.write('\b' * len(f))
+        if woken:
+            break
 
     sys.stdout.write(' ' * len(f) + '\b' * len(f))
 
@@ -254,6 +1107,9 @@ def spinner(duration: float, type: str = 'spinright', start: str = '', end: str
 
 
 def disable_terminal_cursor() -> None:
+    if _headless:
+        return
+
     if os.name == 'posix':
         sys.stdout.write('\033[?25l')
         sys.stdout.flush()
@@ -267,6 +1123,9 @@ def disable_terminal_cursor() -> None:
 
 
 def enable_terminal_cursor() -> None:
+    if _headless:
+        return
+
     if os.name == 'posix':
         sys.stdout.write('\033[?25h')
         sys.stdout.flush()
@@ -281,3 +1140,57 @@ def enable_terminal_cursor() -> None:
 
 def megastrip(text: str) -> str:
     return ' '.join(text.split())
+
+
+def compile_template(template: str, variables: list[str]) -> collections.abc.Callable[[dict[str, any]], str]:
+    # checked once at startup, rendering then only fills in the values
+    template = template.replace('\\n', '\n')
+
+    try:
+        fields: list[tuple[str, str | None, str | None, str | None]] = list(string.Formatter().parse(template))
+    except ValueError:
+        raise ValueError(f'invalid template: {template}')
+
+    for _, field, spec, _ in fields:
+        if field is not None and field not in variables:
+            raise ValueError(f'unknown template variable {{{field}}}, choices: {", ".join(variables)}')
+        if spec and '{' in spec:
+            raise ValueError(f'invalid template: {template}')
+
+    try:
+        template.format_map(dict.fromkeys(variables, ''))
+    except (KeyError, IndexError, ValueError):
+        raise ValueError(f'invalid template: {template}')
+
+    return template.format_map
+
+
+def parse_text_outputs(cache_dir: pathlib.Path, tool: str, values: list[str], variables: list[str]) -> list[dict[str, any]]:
+    # NAME:TEMPLATE, written to TOOL_last_NAME_text
+    outputs: list[dict[str, any]] = []
+
+    for v in values:
+        name, sep, template = v.partition(':')
+
+        if not sep or not OUTPUT_NAME_PATTERN.match(name) or name in [o['name'] for o in outputs]:
+            raise ValueError(f'invalid text output: {v}')
+
+        outputs.append({
+            'name': name,
+            'text_file': cache_dir / f'{tool}_last_{name}_text',
+            'template': compile_template(template, variables),
+        })
+
+    return outputs
+
+
+def write_text_file(file: pathlib.Path, text: str, level: int = logging.INFO) -> bool:
+    # returns whether the file was written
+    if file.is_file() and file.read_text() == text:
+        msg(f'{file.name} is still up to date', level=logging.DEBUG)
+        return False
+
+    msg(f'updating {file.name}', level=level)
+    write_file(file, text.encode())
+
+    return True
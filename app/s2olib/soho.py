@@ -1,7 +1,15 @@
 import argparse
+import concurrent.futures
+import importlib.util
+import io
+import logging
+import math
 import pathlib
+import time
 
+import s2olib.history
 import s2olib.shared
+import s2olib.variants
 
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -20,6 +28,19 @@ CAMERAS: dict[tuple[str, str] | None] = {
 }
 
 DEFAULT_CAMERAS_CHOICE: list[str] = ['all']
+DEFAULT_CONCURRENCY: int = 4
+DEFAULT_MOSAIC_TILE_SIZE: int = 512
+DEFAULT_MOSAIC_QUALITY: int = 90
+
+DEFAULT_HISTORY_MAX_SIZE: int = 100
+DEFAULT_ANIMATION_FRAMES: int = 24
+DEFAULT_ANIMATION_SIZE: int = 512
+DEFAULT_ANIMATION_DURATION: int = 150
+
+MOSAIC_LABEL_HEIGHT: int = 24
+DUE_WINDOW: float = 0.1
+
+HISTORY_DIR_NAME: str = 'soho_history'
 
 ENTRY_FUNC: str = 'daemon'
 
@@ -33,6 +54,74 @@ ARGS: list[dict[str, any]] = [
         'default': DEFAULT_CAMERAS_CHOICE,
         'help': f'Specify one or more camera IDs to download images from. Choices: {", ".join(CAMERAS.keys())}. Default: {" ".join(DEFAULT_CAMERAS_CHOICE)}'
     },
+    {
+        'name_or_flags': ['--soho-concurrency'],
+        'metavar': 'NUM',
+        'type': int,
+        'default': DEFAULT_CONCURRENCY,
+        'help': f'Set the maximum number of camera images to download in parallel. Default: {DEFAULT_CONCURRENCY}'
+    },
+    {
+        'name_or_flags': ['--soho-mosaic'],
+        'action': 'store_true',
+        'default': False,
+        'help': 'Additionally combine the selected camera images into one labeled grid image. Requires Pillow. Default: no mosaic'
+    },
+    {
+        'name_or_flags': ['--soho-mosaic-columns'],
+        'metavar': 'NUM',
+        'type': int,
+        'default': 0,
+        'help': 'Set the number of columns of the mosaic grid. Default: as square as possible'
+    },
+    {
+        'name_or_flags': ['--soho-mosaic-tile-size'],
+        'metavar': 'PX',
+        'type': int,
+        'default': DEFAULT_MOSAIC_TILE_SIZE,
+        'help': f'Set the width and height in pixels of one camera image in the mosaic. Default: {DEFAULT_MOSAIC_TILE_SIZE}'
+    },
+    {
+        'name_or_flags': ['--soho-mosaic-no-labels'],
+        'action': 'store_true',
+        'default': False,
+        'help': 'Do not print the camera names onto the mosaic tiles. Default: print the names'
+    },
+    {
+        'name_or_flags': ['--soho-history'],
+        'metavar': 'NUM',
+        'type': int,
+        'default': 0,
+        'help': 'Keep up to this many past images per camera and export them as an animated loop. Requires Pillow. Default: 0 (no history)'
+    },
+    {
+        'name_or_flags': ['--soho-history-max-size'],
+        'metavar': 'MB',
+        'type': int,
+        'default': DEFAULT_HISTORY_MAX_SIZE,
+        'help': f'Set the maximum size in megabytes of the history of one camera, the oldest images are removed first. Default: {DEFAULT_HISTORY_MAX_SIZE}'
+    },
+    {
+        'name_or_flags': ['--soho-animation-frames'],
+        'metavar': 'NUM',
+        'type': int,
+        'default': DEFAULT_ANIMATION_FRAMES,
+        'help': f'Set how many of the latest history images are used for the animated loop. Default: {DEFAULT_ANIMATION_FRAMES}'
+    },
+    {
+        'name_or_flags': ['--soho-animation-size'],
+        'metavar': 'PX',
+        'type': int,
+        'default': DEFAULT_ANIMATION_SIZE,
+        'help': f'Set the maximum width and height in pixels of the animated loop. Default: {DEFAULT_ANIMATION_SIZE}'
+    },
+    {
+        'name_or_flags': ['--soho-animation-duration'],
+        'metavar': 'MS',
+        'type': int,
+        'default': DEFAULT_ANIMATION_DURATION,
+        'help': f'Set how long each image of the animated loop is shown in milliseconds. Default: {DEFAULT_ANIMATION_DURATION}'
+    },
 ]
 
 
@@ -40,34 +129,155 @@ ARGS: list[dict[str, any]] = [
 
 
 def daemon(args: argparse.Namespace):
-    cache_dir: pathlib.Path = args.cache_dir
-
-    cameras: dict[tuple[str, str]] = {}
-    if 'all' in args.soho_cameras:
-        cameras = CAMERAS
-        del cameras['all']
-    else:
-        for id, cam in CAMERAS.items():
-            if id in args.soho_cameras: cameras[id] = cam
-
-    while True:
-        for id, cam in cameras.items():
-            img_url = cam[1]
-            obs_image_file = cache_dir / f'soho_last_{id}_image'
-            last_content_size: int = obs_image_file.stat().st_size if obs_image_file.is_file() else 0
-
-            s2olib.shared.msg(f'downloading {cam[0]} image')
-            res = s2olib.shared.fetch_remote_data(img_url, args.request_timeout, ['image/jpeg'])
-
-            if not res:
-                s2olib.shared.msg('invalid response data')
-                s2olib.shared.retry_idle(args.retry_delay)
-                continue
-
-            if len(res.content) == last_content_size:
-                s2olib.shared.msg('no change')
-            else:
-                s2olib.shared.msg(f'updating {obs_image_file.name}')
-                obs_image_file.write_bytes(res.content)
-
-        s2olib.shared.endofloop_idle(args.interval)
+    s2olib.shared.run_tools(args, ['soho'])
+
+
+def setup(args: argparse.Namespace) -> dict[str, any]:
+    cameras: dict[str, tuple[str, str]] = get_cameras(args.soho_cameras)
+
+    # Pillow itself is only imported once a mosaic or an animation is made
+    if (args.soho_mosaic or args.soho_history) and importlib.util.find_spec('PIL') is None:
+        s2olib.shared.msg('missing module for --soho-mosaic/--soho-history: Pillow <https://python-pillow.org>', level=logging.ERROR)
+        exit(1)
+
+    return {
+        'cameras': cameras,
+        # each camera keeps its own schedule, so a failing one does not hold back the others
+        'next_run': {id: 0.0 for id in cameras},
+        'pool': concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.soho_concurrency)),
+        'mosaic': None,
+        'mosaic_tiles': {},
+        'animation_frames': {id: {} for id in cameras},
+    }
+
+
+def run(args: argparse.Namespace, state: dict[str, any]) -> float:
+    cameras: dict[str, tuple[str, str]] = state['cameras']
+    next_run: dict[str, float] = state['next_run']
+    pool: concurrent.futures.ThreadPoolExecutor = state['pool']
+
+    # cameras due within a fraction of the interval are fetched with the others,
+    # and the whole batch is scheduled from the same start, so they do not drift apart
+    cycle_start: float = time.time()
+    due_by: float = cycle_start + s2olib.shared.get_interval(args, 'soho') * DUE_WINDOW
+    due: list[str] = [id for id, t in next_run.items() if t <= due_by]
+    jobs: dict[str, concurrent.futures.Future] = {id: pool.submit(update_camera, args, id, cameras[id], state['animation_frames'][id]) for id in due}
+
+    for id, job in jobs.items():
+        next_run[id] = cycle_start + job.result()
+
+    if args.soho_mosaic and jobs:
+        update_mosaic(args, state)
+
+    return max(0.0, min(next_run.values()) - time.time())
+
+
+def snapshot(args: argparse.Namespace, state: dict[str, any]) -> dict[str, any]:
+    return {'next_run': state['next_run']}
+
+
+def restore(args: argparse.Namespace, state: dict[str, any], saved: dict[str, any]) -> None:
+    # cameras that were not selected last time are still fetched right away
+    for id, t in saved.get('next_run', {}).items():
+        if id in state['next_run']:
+            state['next_run'][id] = s2olib.shared.get_resume_time(args, 'soho', t)
+
+
+def poll_now(args: argparse.Namespace, state: dict[str, any]) -> None:
+    for id in state['next_run']:
+        state['next_run'][id] = 0.0
+
+
+def get_cameras(choice: list[str]) -> dict[str, tuple[str, str]]:
+    if 'all' in choice:
+        return {id: cam for id, cam in CAMERAS.items() if cam}
+
+    return {id: cam for id, cam in CAMERAS.items() if cam and id in choice}
+
+
+def update_camera(args: argparse.Namespace, id: str, cam: tuple[str, str], animation_frames: dict[str, any]) -> float:
+    img_url = cam[1]
+    obs_image_file: pathlib.Path = args.cache_dir / f'soho_last_{id}_image'
+
+    s2olib.shared.msg(f'downloading {cam[0]} image', level=logging.DEBUG)
+    updated = s2olib.shared.download_remote_file(img_url, args.request_timeout, ['image/jpeg'], obs_image_file, args.max_download_size)
+
+    if updated is None:
+        s2olib.shared.msg(f'invalid {cam[0]} response data', level=logging.WARNING)
+        return s2olib.shared.retry_later(args, 'soho')
+
+    s2olib.shared.msg(f'updated {obs_image_file.name}' if updated else f'no change for {cam[0]}', level=logging.INFO if updated else logging.DEBUG)
+    s2olib.variants.update(args, obs_image_file)
+
+    if args.soho_history:
+        update_history(args, id, animation_frames)
+
+    return s2olib.shared.get_next_delay(args, 'soho', obs_image_file, updated)
+
+
+def update_history(args: argparse.Namespace, id: str, animation_frames: dict[str, any]) -> None:
+    obs_image_file: pathlib.Path = args.cache_dir / f'soho_last_{id}_image'
+    obs_animation_file: pathlib.Path = args.cache_dir / f'soho_last_{id}_animation'
+    history_dir: pathlib.Path = args.cache_dir / HISTORY_DIR_NAME / id
+
+    added: bool = s2olib.history.add_frame(history_dir, obs_image_file, args.soho_history, args.soho_history_max_size)
+
+    if not added and obs_animation_file.is_file():
+        return
+
+    s2olib.shared.msg(f'updating {obs_animation_file.name}')
+    s2olib.history.export_animation(history_dir, obs_animation_file, args.soho_animation_frames, args.soho_animation_size, args.soho_animation_duration, animation_frames)
+
+
+def update_mosaic(args: argparse.Namespace, state: dict[str, any]) -> None:
+    import PIL.Image # https://python-pillow.org
+    import PIL.ImageDraw
+    import PIL.ImageFont
+
+    cameras: dict[str, tuple[str, str]] = state['cameras']
+    tiles: dict[str, str | None] = state['mosaic_tiles']
+    obs_mosaic_file: pathlib.Path = args.cache_dir / 'soho_last_mosaic_image'
+    size: int = args.soho_mosaic_tile_size
+    columns: int = args.soho_mosaic_columns or math.ceil(math.sqrt(len(cameras)))
+    rows: int = math.ceil(len(cameras) / columns)
+
+    if not state['mosaic']:
+        state['mosaic'] = PIL.Image.new('RGB', (columns * size, rows * size))
+
+    mosaic: PIL.Image.Image = state['mosaic']
+    changed: int = 0
+
+    # only tiles whose source changed since they were drawn get decoded and pasted again
+    for i, (id, cam) in enumerate(cameras.items()):
+        obs_image_file: pathlib.Path = args.cache_dir / f'soho_last_{id}_image'
+        content_hash: str | None = s2olib.shared.get_content_hash(obs_image_file)
+
+        if not content_hash or tiles.get(id) == content_hash:
+            continue
+
+        with PIL.Image.open(obs_image_file) as image:
+            image.draft('RGB', (size, size))
+            tile = image.convert('RGB').resize((size, size), PIL.Image.Resampling.LANCZOS)
+
+        if not args.soho_mosaic_no_labels:
+            draw = PIL.ImageDraw.Draw(tile)
+            draw.rectangle((0, size - MOSAIC_LABEL_HEIGHT, size, size), fill=(0, 0, 0))
+            draw.text((6, size - MOSAIC_LABEL_HEIGHT + 4), cam[0], fill=(255, 255, 255), font=PIL.ImageFont.load_default())
+
+        mosaic.paste(tile, ((i % columns) * size, (i // columns) * size))
+        tiles[id] = content_hash
+        changed += 1
+
+    if not changed and obs_mosaic_file.is_file():
+        return
+
+    buffer = io.BytesIO()
+    mosaic.save(buffer, format='JPEG', quality=DEFAULT_MOSAIC_QUALITY)
+
+    s2olib.shared.msg(f'updating {obs_mosaic_file.name} ({changed} of {len(cameras)} tiles changed)')
+    s2olib.shared.write_file(obs_mosaic_file, buffer.getvalue())
+
+    content_hash = s2olib.shared.new_content_hash()
+    content_hash.update(buffer.getvalue())
+    s2olib.shared.update_fetch_state(obs_mosaic_file, {'hash': content_hash.hexdigest()})
+    s2olib.variants.update(args, obs_mosaic_file)
@@ -0,0 +1,179 @@
+import argparse
+import collections.abc
+import contextlib
+import fnmatch
+import logging
+import os
+import pathlib
+import shutil
+import threading
+import time
+
+import s2olib.shared
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+DEFAULT_QUOTA: int = 0
+DEFAULT_SWEEP_INTERVAL: int = 300
+DEFAULT_HISTORY_LENGTH: int = 100
+
+STORE_DIR_NAME: str = 'store'
+INDEX_FILE_NAME: str = 'index'
+STORED_PATTERN: str = '*_last_*'
+
+ARGS: list[dict[str, any]] = [
+    {
+        'name_or_flags': ['--store-quota'],
+        'metavar': 'MB',
+        'type': int,
+        'default': DEFAULT_QUOTA,
+        'help': 'Keep every version of the output files in a content-addressed store inside the cache directory and limit its size to this many megabytes, the least recently used versions are removed first. Default: 0 (no store)',
+    },
+    {
+        'name_or_flags': ['--store-sweep-interval'],
+        'metavar': 'SEC',
+        'type': int,
+        'default': DEFAULT_SWEEP_INTERVAL,
+        'help': f'Set how often in seconds the store is checked against --store-quota. Default: {DEFAULT_SWEEP_INTERVAL}',
+    },
+]
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def start(args: argparse.Namespace) -> None:
+    if not args.store_quota:
+        return
+
+    store_dir: pathlib.Path = args.cache_dir / STORE_DIR_NAME
+    store_dir.mkdir(exist_ok=True)
+
+    for file in sorted(args.cache_dir.glob(STORED_PATTERN)):
+        add(file)
+
+    s2olib.shared.add_publish_hook(add)
+
+    def sweep_loop() -> None:
+        while True:
+            sweep(store_dir, args.store_quota * 1024 * 1024)
+            time.sleep(max(1, args.store_sweep_interval))
+
+    threading.Thread(target=sweep_loop, daemon=True).start()
+
+
+def add(file: pathlib.Path) -> None:
+    # called whenever a file is published, the file is always replaced as a whole,
+    # so its current inode can be shared with the blob of the same content
+    if file.name.startswith('.') or not fnmatch.fnmatchcase(file.name, STORED_PATTERN) or not file.is_file():
+        return
+
+    store_dir: pathlib.Path = file.parent / STORE_DIR_NAME
+    tmp_file: pathlib.Path = s2olib.shared.get_tmp_file(store_dir / file.name)
+
+    try:
+        # pin the content first, so a new version written in the meantime cannot end up under the wrong hash
+        try:
+            os.link(file, tmp_file)
+            linked: bool = True
+        except OSError:
+            shutil.copyfile(file, tmp_file)
+            linked = False
+
+        content_hash: str = get_file_hash(tmp_file)
+        blob_file: pathlib.Path = get_blob_file(store_dir, content_hash)
+
+        with store_index(store_dir) as index:
+            if not blob_file.is_file():
+                blob_file.parent.mkdir(exist_ok=True)
+                os.replace(tmp_file, blob_file)
+            elif linked and not os.path.samefile(blob_file, file) and os.path.samefile(tmp_file, file):
+                # the same content is stored already, the name becomes one more link to it
+                replace_with_link(blob_file, file)
+                s2olib.shared.add_metric(['store', 'deduplicated'])
+
+            if index['files'].get(file.name) != content_hash:
+                history: list[str] = index['history'].setdefault(file.name, [])
+                history.append(content_hash)
+                del history[:-DEFAULT_HISTORY_LENGTH]
+
+            index['files'][file.name] = content_hash
+            index['blobs'][content_hash] = {'size': blob_file.stat().st_size, 'used': time.time()}
+
+    except OSError as e:
+        s2olib.shared.msg(f'failed to store {file.name}: {e}', level=logging.WARNING)
+
+    finally:
+        tmp_file.unlink(missing_ok=True)
+
+
+def sweep(store_dir: pathlib.Path, quota: int) -> None:
+    # removes the least recently used blobs until the store fits into the quota again,
+    # blobs still behind an output file are never removed
+    with store_index(store_dir) as index:
+        in_use: set[str] = set(index['files'].values())
+        size: int = sum(v['size'] for v in index['blobs'].values())
+
+        for content_hash, blob in sorted(index['blobs'].items(), key=lambda v: v[1]['used']):
+            if size <= quota:
+                break
+
+            blob_file: pathlib.Path = get_blob_file(store_dir, content_hash)
+
+            # another link means some file still shows this content, even if the index does not know it
+            if content_hash in in_use or (blob_file.is_file() and blob_file.stat().st_nlink > 1):
+                continue
+
+            blob_file.unlink(missing_ok=True)
+            del index['blobs'][content_hash]
+            size -= blob['size']
+            s2olib.shared.add_metric(['store', 'evicted'])
+
+        for name, history in index['history'].items():
+            index['history'][name] = [v for v in history if v in index['blobs']]
+
+        s2olib.shared.set_metric(['store', 'bytes'], size)
+        s2olib.shared.set_metric(['store', 'blobs'], len(index['blobs']))
+
+    if size > quota:
+        s2olib.shared.msg(f'store still holds {s2olib.shared.bytes_for_humans(size, "mb")} after the sweep, the current files are never removed', level=logging.WARNING)
+
+
+def get_blob_file(store_dir: pathlib.Path, content_hash: str) -> pathlib.Path:
+    # spread over subdirectories, so no directory grows too large
+    return store_dir / content_hash[:2] / content_hash
+
+
+def get_file_hash(file: pathlib.Path) -> str:
+    content_hash = s2olib.shared.new_content_hash()
+
+    with file.open('rb') as f:
+        while chunk := f.read(s2olib.shared.DOWNLOAD_CHUNK_SIZE):
+            content_hash.update(chunk)
+
+    return content_hash.hexdigest()
+
+
+def replace_with_link(source: pathlib.Path, file: pathlib.Path) -> None:
+    # link next to the target and swap it in, like write_file() does
+    tmp_file: pathlib.Path = s2olib.shared.get_tmp_file(file)
+
+    try:
+        os.link(source, tmp_file)
+        os.replace(tmp_file, file)
+    finally:
+        tmp_file.unlink(missing_ok=True)
+
+
+@contextlib.contextmanager
+def store_index(store_dir: pathlib.Path) -> collections.abc.Iterator[dict[str, dict[str, any]]]:
+    index_file: pathlib.Path = store_dir / INDEX_FILE_NAME
+
+    with s2olib.shared.lock_file(index_file.with_name(f'{index_file.name}.lock')):
+        index: dict[str, dict[str, any]] = s2olib.shared.read_json_file(index_file, {})
+        for k in ['files', 'blobs', 'history']:
+            index.setdefault(k, {})
+        yield index
+        s2olib.shared.write_json_file(index_file, index)
@@ -0,0 +1,176 @@
+import argparse
+import concurrent.futures
+import fnmatch
+import importlib.util
+import io
+import logging
+import multiprocessing
+import pathlib
+import threading
+
+import s2olib.imageinfo
+import s2olib.shared
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+MODE_CHOICES: list[str] = ['fit', 'crop']
+FORMAT_CHOICES: list[str] = ['jpeg', 'png', 'webp']
+
+DEFAULT_MODE: str = 'fit'
+DEFAULT_FORMAT: str = 'jpeg'
+DEFAULT_QUALITY: int = 85
+DEFAULT_WORKERS: int = 2
+
+ARGS: list[dict[str, any]] = [
+    {
+        'name_or_flags': ['--image-variants'],
+        'metavar': 'SPEC',
+        'type': str,
+        'nargs': '+',
+        'default': [],
+        'help': f'Produce resized copies of downloaded images. SPEC is FILE:WIDTHxHEIGHT[:MODE[:FORMAT[:QUALITY]]], FILE may contain wildcards, e.g. soho_last_*_image:512x512:crop. Modes: {", ".join(MODE_CHOICES)}. Formats: {", ".join(FORMAT_CHOICES)}. Default: none',
+    },
+    {
+        'name_or_flags': ['--image-variant-workers'],
+        'metavar': 'NUM',
+        'type': int,
+        'default': DEFAULT_WORKERS,
+        'help': f'Set the number of worker processes producing image variants. Default: {DEFAULT_WORKERS}',
+    },
+]
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+_pool: concurrent.futures.ProcessPoolExecutor | None = None
+_pending: dict[pathlib.Path, concurrent.futures.Future] = {}
+_pending_lock: threading.Lock = threading.Lock()
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def parse_specs(values: list[str]) -> list[dict[str, any]]:
+    specs: list[dict[str, any]] = []
+
+    for v in values:
+        parts: list[str] = v.split(':')
+
+        try:
+            width, height = [int(n) for n in parts[1].lower().split('x')]
+            spec: dict[str, any] = {
+                'pattern': parts[0],
+                'width': width,
+                'height': height,
+                'mode': parts[2] if len(parts) > 2 else DEFAULT_MODE,
+                'format': parts[3].lower() if len(parts) > 3 else DEFAULT_FORMAT,
+                'quality': int(parts[4]) if len(parts) > 4 else DEFAULT_QUALITY,
+            }
+        except (IndexError, ValueError):
+            raise ValueError(f'invalid image variant: {v}')
+
+        if not spec['pattern'] or spec['mode'] not in MODE_CHOICES or spec['format'] not in FORMAT_CHOICES or len(parts) > 5:
+            raise ValueError(f'invalid image variant: {v}')
+
+        specs.append(spec)
+
+    # Pillow itself is only imported by the worker processes
+    if specs and importlib.util.find_spec('PIL') is None:
+        raise ValueError('missing module for --image-variants: Pillow <https://python-pillow.org>')
+
+    return specs
+
+
+def get_variant_file(source_file: pathlib.Path, spec: dict[str, any]) -> pathlib.Path:
+    suffix: str = f'{spec["width"]}x{spec["height"]}' + ('_crop' if spec['mode'] == 'crop' else '')
+    return source_file.with_name(f'{source_file.name}_{suffix}')
+
+
+def update(args: argparse.Namespace, source_file: pathlib.Path) -> None:
+    # hands the work to the worker processes and returns right away
+    if not source_file.is_file():
+        return
+
+    for spec in args.image_variants:
+        if not fnmatch.fnmatchcase(source_file.name, spec['pattern']):
+            continue
+
+        variant_file: pathlib.Path = get_variant_file(source_file, spec)
+        source_hash: str | None = s2olib.shared.get_content_hash(source_file)
+
+        if variant_file.is_file() and s2olib.shared.get_fetch_state(variant_file).get('source_hash') == source_hash:
+            continue
+
+        with _pending_lock:
+            if variant_file in _pending:
+                continue
+
+            job = get_pool(args).submit(render_variant, source_file, variant_file, spec)
+            job.add_done_callback(lambda job, variant_file=variant_file: finish_variant(job, variant_file))
+            _pending[variant_file] = job
+
+
+def finish_variant(job: concurrent.futures.Future, variant_file: pathlib.Path) -> None:
+    with _pending_lock:
+        _pending.pop(variant_file, None)
+
+    if job.exception():
+        s2olib.shared.msg(f'failed to produce {variant_file.name}: {job.exception()}', level=logging.WARNING)
+        return
+
+    source_hash, content_hash = job.result()
+    s2olib.shared.update_fetch_state(variant_file, {'source_hash': source_hash, 'hash': content_hash, 'image': s2olib.imageinfo.read_image_info(variant_file)})
+    s2olib.shared.publish(variant_file)
+    s2olib.shared.msg(f'updated {variant_file.name}')
+
+
+def get_pool(args: argparse.Namespace) -> concurrent.futures.ProcessPoolExecutor:
+    global _pool
+
+    if not _pool:
+        # forking from the download threads could copy a lock held by one of them into the worker
+        _pool = concurrent.futures.ProcessPoolExecutor(max_workers=max(1, args.image_variant_workers), mp_context=multiprocessing.get_context('spawn'))
+
+    return _pool
+
+
+def shutdown() -> None:
+    # waits for the variants still in the works, their files are published before this returns
+    global _pool
+
+    if _pool:
+        _pool.shutdown(wait=True)
+        _pool = None
+
+
+def render_variant(source_file: pathlib.Path, variant_file: pathlib.Path, spec: dict[str, any]) -> tuple[str, str]:
+    # runs in a worker process, returns the content hashes of the source as it was read and of the written variant,
+    # the source may have been replaced again since the job was handed over
+    import PIL.Image # https://python-pillow.org
+    import PIL.ImageOps
+
+    data: bytes = source_file.read_bytes()
+    source_hash = s2olib.shared.new_content_hash()
+    source_hash.update(data)
+
+    with PIL.Image.open(io.BytesIO(data)) as image:
+        image = image.convert('RGB') if spec['format'] == 'jpeg' else image.convert('RGBA')
+
+        if spec['mode'] == 'crop':
+            image = PIL.ImageOps.fit(image, (spec['width'], spec['height']), PIL.Image.Resampling.LANCZOS)
+        else:
+            image = PIL.ImageOps.contain(image, (spec['width'], spec['height']), PIL.Image.Resampling.LANCZOS)
+
+        buffer = io.BytesIO()
+        image.save(buffer, format=spec['format'].upper(), quality=spec['quality'])
+
+    # published by finish_variant() in the main process
+    s2olib.shared.replace_file(variant_file, buffer.getvalue())
+
+    content_hash = s2olib.shared.new_content_hash()
+    content_hash.update(buffer.getvalue())
+
+    return source_hash.hexdigest(), content_hash.hexdigest()
@@ -2,6 +2,7 @@
 
 import argparse
 import importlib
+import logging
 import pathlib
 import sys
 
@@ -11,19 +12,12 @@ import s2olib.shared
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 
-try:
-    import requests
-except ImportError as e:
-    sys.stderr.write('missing module: requests <https://github.com/psf/requests>\n')
-    exit(1)
-
-
 if __name__ == '__main__':
     argparser = argparse.ArgumentParser(**s2olib.shared.ARGPARSER_SETUP)
 
     s2olib.shared.add_args(dest=argparser, args=[s2olib.shared.ARG_TOOL])
 
-    for v in s2olib.shared.ARG_GROUPS:
+    for v in s2olib.shared.get_arg_groups(sys.argv[1:]):
         group = argparser.add_argument_group(title=v[0])
         s2olib.shared.add_args(dest=group, args=v[1])
 
@@ -33,22 +27,49 @@ if __name__ == '__main__':
 
     args = argparser.parse_args()
 
+    s2olib.shared.setup_output(args)
+
     args.cache_dir = pathlib.Path(args.cache_dir).resolve()
     args.secrets_file = pathlib.Path(args.secrets_file).resolve()
 
     if not args.cache_dir.is_dir():
-        s2olib.shared.msg(f'cache directory path does not point to a directory: {args.cache_dir}')
+        s2olib.shared.msg(f'cache directory path does not point to a directory: {args.cache_dir}', level=logging.ERROR)
         exit(1)
 
     if not args.secrets_file.is_file():
-        s2olib.shared.msg(f'secrets file path does not point to a file: {args.secrets_file}')
+        s2olib.shared.msg(f'secrets file path does not point to a file: {args.secrets_file}', level=logging.ERROR)
         exit(1)
 
+    try:
+        args.tool_interval = s2olib.shared.parse_tool_seconds(args.tool_interval)
+        args.tool_retry_delay = s2olib.shared.parse_tool_seconds(args.tool_retry_delay)
+        if args.image_variants:
+            args.image_variants = importlib.import_module('s2olib.variants').parse_specs(args.image_variants)
+    except ValueError as e:
+        s2olib.shared.msg(str(e), level=logging.ERROR)
+        exit(1)
+
+    tools: list[str] = s2olib.shared.get_tools(args.tool)
+
     try:
         s2olib.shared.disable_terminal_cursor()
-        s2olib.shared.msg(f'-=[ space2obs :: {args.tool} ]=-', plain=True, end='\n\n')
-        module = importlib.import_module(f's2olib.{args.tool}')
-        getattr(module, module.ENTRY_FUNC)(args)
+        s2olib.shared.msg(f'-=[ space2obs :: {", ".join(tools)} ]=-', plain=True, end='\n\n')
+        try:
+            s2olib.shared.setup_session(args.pool_size, args.max_retries)
+        except ImportError:
+            s2olib.shared.msg('missing module: requests <https://github.com/psf/requests>', level=logging.ERROR)
+            exit(1)
+        # the extras are only loaded when they are used
+        if args.store_quota:
+            importlib.import_module('s2olib.store').start(args)
+        if args.server_port:
+            importlib.import_module('s2olib.server').start(args)
+        s2olib.shared.start_metrics_file(args)
+        if len(tools) == 1:
+            module = importlib.import_module(f's2olib.{tools[0]}')
+            getattr(module, module.ENTRY_FUNC)(args)
+        else:
+            s2olib.shared.run_tools(args, tools)
     except KeyboardInterrupt:
         s2olib.shared.msg('[quit]', start='\n')
     finally: